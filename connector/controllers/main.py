@@ -9,10 +9,8 @@ from openerp import http, tools
 from openerp.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
 
 from ..session import ConnectorSessionHandler
-from ..queue.job import (OpenERPJobStorage,
-                         ENQUEUED)
-from ..exception import (NoSuchJobError,
-                         NotReadableJobError,
+from ..queue.job import OpenERPJobStorage
+from ..exception import (NotReadableJobError,
                          RetryableJobError,
                          FailedJobError,
                          NothingToDoJob)
@@ -30,37 +28,23 @@ class RunJobController(http.Controller):
 
     job_storage_class = OpenERPJobStorage
 
-    def _load_job(self, session, job_uuid):
-        """ Reload a job from the backend """
+    def _claim_job(self, session, job_uuid):
+        """ Set the job as started and load it if it is enqueued """
         try:
-            job = self.job_storage_class(session).load(job_uuid)
-        except NoSuchJobError:
-            # just skip it
-            job = None
+            job = self.job_storage_class(session).claim(job_uuid)
         except NotReadableJobError:
             _logger.exception('Could not read job: %s', job_uuid)
             raise
-        return job
-
-    def _try_perform_job(self, session_hdl, job):
-        """Try to perform the job."""
-
         # if the job has been manually set to DONE or PENDING,
         # or if something tries to run a job that is not enqueued
         # before its execution, stop
-        if job.state != ENQUEUED:
-            _logger.warning('job %s is in state %s '
-                            'instead of enqueued in /runjob',
-                            job.uuid, job.state)
-            return
-
-        with session_hdl.session() as session:
-            # TODO: set_started should be done atomically with
-            #       update queue_job set=state=started
-            #       where state=enqueid and id=
-            job.set_started()
-            self.job_storage_class(session).store(job)
+        if job is None:
+            _logger.warning('job %s does not exist or is not enqueued '
+                            'in /runjob', job_uuid)
+        return job
 
+    def _try_perform_job(self, session_hdl, job):
+        """Try to perform the job, which has been claimed as started."""
         _logger.debug('%s started', job)
         with session_hdl.session() as session:
             job.perform(session)
@@ -74,6 +58,26 @@ class RunJobController(http.Controller):
         http.request.session._db = db
         session_hdl = ConnectorSessionHandler(db,
                                               openerp.SUPERUSER_ID)
+        self._runjob(session_hdl, job_uuid)
+        return ""
+
+    @http.route('/connector/runjobs', type='http', auth='none')
+    def runjobs(self, db, job_uuids, **kw):
+        """ Run several jobs of a database one after the other """
+        http.request.session._db = db
+        session_hdl = ConnectorSessionHandler(db,
+                                              openerp.SUPERUSER_ID)
+        for job_uuid in job_uuids.split(','):
+            try:
+                self._runjob(session_hdl, job_uuid)
+            except Exception:
+                # the error has been logged and the job stored as failed,
+                # the next jobs must run anyway
+                continue
+        return ""
+
+    def _runjob(self, session_hdl, job_uuid):
+        """ Run a job, the errors are raised after the job is stored """
 
         def retry_postpone(job, message, seconds=None):
             with session_hdl.session() as session:
@@ -87,9 +91,9 @@ class RunJobController(http.Controller):
             env.all.todo.clear()
 
         with session_hdl.session() as session:
-            job = self._load_job(session, job_uuid)
+            job = self._claim_job(session, job_uuid)
             if job is None:
-                return ""
+                return
 
         try:
             try:
@@ -131,5 +135,3 @@ class RunJobController(http.Controller):
                 clear_env(session.env)
                 self.job_storage_class(session).store(job)
             raise
-
-        return ""
@@ -31,7 +31,8 @@ import time
 from openerp.service import server
 from openerp.tools import config
 
-from .runner import ConnectorRunner, _channels
+from .runner import (ConnectorRunner, _channels, _dispatch_workers,
+                     _endpoints, _metrics_address)
 
 _logger = logging.getLogger(__name__)
 
@@ -50,7 +51,10 @@ class ConnectorRunnerThread(Thread):
         self.daemon = True
         port = os.environ.get('ODOO_CONNECTOR_PORT') or config['xmlrpc_port']
         channels = _channels()
-        self.runner = ConnectorRunner(port or 8069, channels or 'root:1')
+        self.runner = ConnectorRunner(port or 8069, channels or 'root:1',
+                                      _dispatch_workers(),
+                                      _metrics_address(),
+                                      _endpoints())
 
     def run(self):
         # sleep a bit to let the workers start at ease
@@ -69,7 +73,10 @@ class WorkerJobRunner(server.Worker):
         self.watchdog_timeout = None
         port = os.environ.get('ODOO_CONNECTOR_PORT') or config['xmlrpc_port']
         channels = _channels()
-        self.runner = ConnectorRunner(port, channels or 'root:1')
+        self.runner = ConnectorRunner(port, channels or 'root:1',
+                                      _dispatch_workers(),
+                                      _metrics_address(),
+                                      _endpoints())
 
     def sleep(self):
         pass
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#     This file is part of connector, an Odoo module.
+#
+#     connector is free software: you can redistribute it and/or
+#     modify it under the terms of the GNU Affero General Public License
+#     as published by the Free Software Foundation, either version 3 of
+#     the License, or (at your option) any later version.
+#
+#     connector is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU Affero General Public License for more details.
+#
+#     You should have received a copy of the
+#     GNU Affero General Public License
+#     along with connector.
+#     If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+"""
+Scheduling simulator for the job runner channels.
+
+It drives a :py:class:`~connector.jobrunner.channels.ChannelManager` with a
+synthetic stream of jobs, the way the runner does, without Odoo nor a
+database. Time is simulated: jobs arrive following a Poisson process,
+last a random duration, and some of them fail and are retried later with
+an eta, like jobs raising a ``RetryableJobError``.
+
+It reports the dispatch latency percentiles (simulated seconds between the
+moment a job is ready to run and the moment it is dispatched), the number
+of jobs scheduled per second of CPU time and the peak memory, so scheduler
+changes can be judged with numbers.
+
+Run it with the ``openerp-connector-jobrunner-benchmark`` script, at the
+root of the connector module, for instance::
+
+    ./openerp-connector-jobrunner-benchmark --jobs 1000000 \\
+        --config root:8:fair,A:4,B:4,C:1:sequential --load A=6,B=3,C=1 \\
+        -- --addons-path=...
+"""
+
+import argparse
+from heapq import heappush, heappop
+import random
+import resource
+import time
+
+from .channels import ChannelManager
+
+
+def percentile(sorted_values, ratio):
+    """ Return the percentile of a sorted list of values
+
+    >>> percentile(range(1, 101), 0.9)
+    90
+    """
+    if not sorted_values:
+        return None
+    index = int(round(ratio * len(sorted_values))) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def parse_load(load_string):
+    """ Parse the share of the jobs created in each channel
+
+    >>> sorted(parse_load('A=6, B=3,root=1').items())
+    [('A', 6.0), ('B', 3.0), ('root', 1.0)]
+    """
+    load = {}
+    for item in load_string.split(','):
+        name, _, share = item.partition('=')
+        load[name.strip()] = float(share or 1)
+    return load
+
+
+def simulate(jobs=100000, config='root:8,A:4,B:2,C:1:sequential',
+             load='A=6,B=3,C=1', arrival_rate=200., duration=0.05,
+             priorities=(5, 10, 20), eta_ratio=0.05, max_eta=600.,
+             failure_ratio=0.01, retry_delay=60., seed=42):
+    """ Run a simulation and return a dictionary of statistics.
+
+    :param jobs: number of jobs to create
+    :param config: channels configuration string
+    :param load: share of jobs created in each channel (see parse_load)
+    :param arrival_rate: mean number of jobs created per simulated second
+    :param duration: mean duration of a job in simulated seconds
+    :param priorities: priorities given randomly to the jobs
+    :param eta_ratio: ratio of jobs created with an eta
+    :param max_eta: maximum delay of the eta of the jobs
+    :param failure_ratio: ratio of executions that fail and are retried
+    :param retry_delay: delay before a failed job is retried
+    :param seed: seed of the random generator
+    """
+    rnd = random.Random(seed)
+    clock = [0.]
+    cm = ChannelManager()
+    cm.simple_configure(config)
+    for channel in cm._channels_by_name.values():
+        if channel.rate_limit:
+            # rate limits follow the simulated time
+            channel.rate_limit.clock = lambda: clock[0]
+            channel.rate_limit._last = 0.
+    load = parse_load(load)
+    channel_names = sorted(load)
+    total_share = sum(load.values())
+
+    def random_channel():
+        value = rnd.random() * total_share
+        for name in channel_names:
+            value -= load[name]
+            if value < 0:
+                return name
+        return channel_names[-1]
+
+    pending = {}  # uuid -> (channel, date_created, priority, eta, ready)
+    running = []  # heap of (end time, uuid)
+    latencies = {}  # channel -> list of latencies
+    created = done = retries = dispatched = max_jobs = 0
+    next_arrival = 0.
+    cpu_time = 0.
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    now = 0.
+    while done < jobs:
+        clock[0] = now
+        start = time.time()
+        # new jobs
+        while created < jobs and next_arrival <= now:
+            channel = random_channel()
+            priority = rnd.choice(priorities)
+            eta = None
+            if rnd.random() < eta_ratio:
+                eta = next_arrival + rnd.random() * max_eta
+            pending[created] = (channel, next_arrival, priority,
+                                eta, eta or next_arrival)
+            cm.notify('db', channel, created, created, next_arrival,
+                      priority, eta, 'pending')
+            created += 1
+            next_arrival += rnd.expovariate(arrival_rate)
+        # finished jobs
+        while running and running[0][0] <= now:
+            __, uuid = heappop(running)
+            channel, date_created, priority, eta, __ = pending[uuid]
+            if rnd.random() < failure_ratio:
+                eta = now + retry_delay
+                pending[uuid] = (channel, date_created, priority, eta, eta)
+                cm.notify('db', channel, uuid, uuid, date_created,
+                          priority, eta, 'pending')
+                retries += 1
+            else:
+                del pending[uuid]
+                cm.notify('db', channel, uuid, uuid, date_created,
+                          priority, eta, 'done')
+                done += 1
+        # dispatch
+        for job in cm.get_jobs_to_run(now):
+            channel, date_created, priority, eta, ready = pending[job.uuid]
+            # the runner is notified when the job is enqueued
+            cm.notify('db', channel, job.uuid, job.uuid, date_created,
+                      priority, eta, 'enqueued')
+            latencies.setdefault(channel, []).append(now - ready)
+            heappush(running, (now + rnd.expovariate(1. / duration),
+                               job.uuid))
+            dispatched += 1
+        cpu_time += time.time() - start
+        max_jobs = max(max_jobs, len(pending))
+        # advance the simulated time to the next event
+        next_times = []
+        if created < jobs:
+            next_times.append(next_arrival)
+        if running:
+            next_times.append(running[0][0])
+        wakeup = cm.get_wakeup_time(now)
+        if wakeup is not None:
+            next_times.append(wakeup)
+        rate_limit_delay = cm.get_rate_limit_delay()
+        if rate_limit_delay is not None:
+            next_times.append(now + rate_limit_delay)
+        if not next_times:
+            # nothing can happen anymore
+            break
+        now = max(now, min(next_times))
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stats = {
+        'jobs': jobs,
+        'done': done,
+        'dispatched': dispatched,
+        'retries': retries,
+        'simulated_seconds': now,
+        'cpu_seconds': cpu_time,
+        'jobs_per_second': dispatched / cpu_time if cpu_time else None,
+        'max_pending_jobs': max_jobs,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_memory_increase_mb': (rss_after - rss_before) / 1024.,
+        'latency': {},
+    }
+    all_latencies = []
+    for channel, values in latencies.items():
+        all_latencies.extend(values)
+        stats['latency'][channel] = _latency_stats(values)
+    stats['latency']['all'] = _latency_stats(all_latencies)
+    return stats
+
+
+def _latency_stats(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else None,
+    }
+
+
+def format_stats(stats):
+    lines = [
+        "jobs: %(jobs)d, done: %(done)d, dispatched: %(dispatched)d, "
+        "retries: %(retries)d" % stats,
+        "simulated time: %(simulated_seconds).1fs, "
+        "scheduler cpu time: %(cpu_seconds).2fs" % stats,
+        "throughput: %.0f jobs/s" % (stats['jobs_per_second'] or 0),
+        "max pending jobs: %(max_pending_jobs)d, "
+        "peak memory increase: %(peak_memory_increase_mb).1f MB" % stats,
+        "dispatch latency (simulated seconds):",
+    ]
+    for channel in sorted(stats['latency']):
+        latency = stats['latency'][channel]
+        if not latency['count']:
+            continue
+        lines.append("  %-10s count %8d  mean %8.2f  p50 %8.2f  p90 %8.2f  "
+                     "p99 %8.2f  max %8.2f" %
+                     (channel, latency['count'], latency['mean'],
+                      latency['p50'], latency['p90'], latency['p99'],
+                      latency['max']))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate the job runner scheduling")
+    parser.add_argument('--jobs', type=int, default=100000)
+    parser.add_argument('--config', default='root:8,A:4,B:2,C:1:sequential',
+                        help="channels configuration")
+    parser.add_argument('--load', default='A=6,B=3,C=1',
+                        help="share of the jobs created in each channel")
+    parser.add_argument('--arrival-rate', type=float, default=200.,
+                        help="jobs created per simulated second")
+    parser.add_argument('--duration', type=float, default=0.05,
+                        help="mean duration of the jobs")
+    parser.add_argument('--eta-ratio', type=float, default=0.05)
+    parser.add_argument('--failure-ratio', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args(args)
+    stats = simulate(jobs=options.jobs,
+                     config=options.config,
+                     load=options.load,
+                     arrival_rate=options.arrival_rate,
+                     duration=options.duration,
+                     eta_ratio=options.eta_ratio,
+                     failure_ratio=options.failure_ratio,
+                     seed=options.seed)
+    print(format_stats(stats))
+    return stats
@@ -23,13 +23,21 @@
 #
 ##############################################################################
 
-from heapq import heappush, heappop
+from heapq import heapify, heappush, heappop
 import logging
+import time
 from weakref import WeakValueDictionary
 
 from ..exception import ChannelNotFound
 from ..queue.job import PENDING, ENQUEUED, STARTED, FAILED, DONE
 NOT_DONE = (PENDING, ENQUEUED, STARTED, FAILED)
+# transitions counted in the channels
+TRANSITIONS = (PENDING, 'running', FAILED, DONE)
+
+# a priority queue is compacted when it has more than COMPACT_MIN_REMOVED
+# removed objects and they are more than COMPACT_RATIO of its heap
+COMPACT_MIN_REMOVED = 1000
+COMPACT_RATIO = 0.5
 
 _logger = logging.getLogger(__name__)
 
@@ -64,16 +72,40 @@ class PriorityQueue(object):
     >>> q.add(2)
     >>> q.pop()
     2
+
+    Removed objects are purged lazily when they reach the top of
+    the heap, or when they are too many compared to the heap size.
+
+    >>> q = PriorityQueue(compact_min_removed=2)
+    >>> for i in range(4):
+    ...     q.add(i)
+    >>> q.remove(1)
+    >>> q.remove(2)
+    >>> len(q), q.heap_size
+    (2, 4)
+    >>> q.remove(3)
+    >>> len(q), q.heap_size
+    (1, 1)
+    >>> q.pop()
+    0
     """
 
-    def __init__(self):
+    def __init__(self, compact_min_removed=COMPACT_MIN_REMOVED,
+                 compact_ratio=COMPACT_RATIO):
         self._heap = []
         self._known = set()    # all objects in the heap (including removed)
         self._removed = set()  # all objects that have been removed
+        self.compact_min_removed = compact_min_removed
+        self.compact_ratio = compact_ratio
 
     def __len__(self):
         return len(self._known) - len(self._removed)
 
+    @property
+    def heap_size(self):
+        """ Number of objects in the heap, including removed ones """
+        return len(self._heap)
+
     def __getitem__(self, i):
         if i != 0:
             raise IndexError()
@@ -109,6 +141,18 @@ class PriorityQueue(object):
             return
         if o not in self._removed:
             self._removed.add(o)
+            if (len(self._removed) > self.compact_min_removed and
+                    len(self._removed) > self.compact_ratio * len(self._heap)):
+                self.compact()
+
+    def compact(self):
+        """ Purge all removed objects from the heap. """
+        _logger.debug("compacting priority queue: %d removed objects "
+                      "in a heap of %d", len(self._removed), len(self._heap))
+        self._heap = [o for o in self._heap if o not in self._removed]
+        heapify(self._heap)
+        self._known.difference_update(self._removed)
+        self._removed.clear()
 
     def pop(self):
         while True:
@@ -124,6 +168,98 @@ class PriorityQueue(object):
                 return o
 
 
+class TokenBucket(object):
+    """A token bucket allowing ``rate`` events per ``period`` seconds.
+
+    The bucket holds at most ``rate`` tokens, so bursts are limited to
+    ``rate`` events.
+
+    >>> clock = [0]
+    >>> bucket = TokenBucket(2, 10, clock=lambda: clock[0])
+    >>> [bucket.consume() for i in range(3)]
+    [True, True, False]
+    >>> bucket.wait_time()
+    5.0
+    >>> clock[0] = 5
+    >>> bucket.available()
+    True
+    >>> bucket.tokens()
+    1
+    >>> bucket.consume()
+    True
+    """
+
+    def __init__(self, rate, period, clock=time.time):
+        self.rate = rate
+        self.period = float(period)
+        self.clock = clock
+        self._tokens = float(rate)
+        self._last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.rate, self._tokens +
+                           (now - self._last) * self.rate / self.period)
+        self._last = now
+
+    def available(self):
+        """ Return True if an event is allowed now """
+        self._refill()
+        return self._tokens >= 1
+
+    def tokens(self):
+        """ Return the number of events allowed now """
+        self._refill()
+        return int(self._tokens)
+
+    def consume(self):
+        """ Consume a token if possible, return True if it was """
+        if not self.available():
+            return False
+        self._tokens -= 1
+        return True
+
+    def wait_time(self):
+        """ Seconds until the next token is available """
+        self._refill()
+        if self._tokens >= 1:
+            return 0.
+        return (1 - self._tokens) * self.period / self.rate
+
+
+def parse_rate(value):
+    """Parse a rate in the ``count/period`` form.
+
+    Return a tuple ``(count, period in seconds)``. The period is a
+    number of seconds, optionally followed by a unit (s, m or h).
+    If the period is omitted it defaults to one second.
+
+    >>> parse_rate('10/60')
+    (10, 60.0)
+    >>> parse_rate('30/m')
+    (30, 60.0)
+    >>> parse_rate('2/0.5h')
+    (2, 1800.0)
+    >>> parse_rate('5')
+    (5, 1.0)
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    count, _, period = value.partition('/')
+    try:
+        count = int(count)
+        period = period.strip() or '1'
+        unit = 1
+        if period[-1] in units:
+            unit = units[period[-1]]
+            period = period[:-1] or '1'
+        period = float(period) * unit
+    except ValueError:
+        raise ValueError('Invalid rate %s' % value)
+    if count <= 0 or period <= 0:
+        raise ValueError('Invalid rate %s' % value)
+    return count, period
+
+
 class SafeSet(set):
     """A set that does not raise KeyError when removing non-existent items.
 
@@ -140,6 +276,64 @@ class SafeSet(set):
             pass
 
 
+class RunningSet(SafeSet):
+    """The set of the running jobs of a channel, which counts the slots
+    they use: the jobs of a batch run in the same request and share a slot.
+
+    >>> j1 = ChannelJob(None, None, 1,
+    ...                 seq=0, date_created=1, priority=1, eta=None)
+    >>> j2 = ChannelJob(None, None, 2,
+    ...                 seq=0, date_created=2, priority=1, eta=None)
+    >>> j3 = ChannelJob(None, None, 3,
+    ...                 seq=0, date_created=3, priority=1, eta=None)
+    >>> j1.batch = j2.batch = (j1, j2)
+    >>> s = RunningSet()
+    >>> for job in (j1, j2, j3):
+    ...     s.add(job)
+    >>> len(s), s.slot_count
+    (3, 2)
+    >>> s.remove(j1)
+    >>> len(s), s.slot_count
+    (2, 2)
+    >>> s.remove(j2)
+    >>> len(s), s.slot_count
+    (1, 1)
+    """
+
+    def __init__(self):
+        super(RunningSet, self).__init__()
+        # the slot of a job is kept as its batch is reset when it is
+        # set back to pending
+        self._slot_by_job = {}
+        self._slot_jobs = {}  # number of running jobs by slot
+
+    def add(self, o):
+        if o in self:
+            return
+        super(RunningSet, self).add(o)
+        slot = o.batch[0] if o.batch else o
+        self._slot_by_job[o] = slot
+        self._slot_jobs[slot] = self._slot_jobs.get(slot, 0) + 1
+
+    def get_slot(self, o):
+        """ Return the first job of the slot used by a running job """
+        return self._slot_by_job[o]
+
+    def remove(self, o):
+        if o not in self:
+            return
+        super(RunningSet, self).remove(o)
+        slot = self._slot_by_job.pop(o)
+        self._slot_jobs[slot] -= 1
+        if not self._slot_jobs[slot]:
+            del self._slot_jobs[slot]
+
+    @property
+    def slot_count(self):
+        """ Number of slots used by the running jobs """
+        return len(self._slot_jobs)
+
+
 class ChannelJob(object):
     """A channel job is attached to a channel and holds the properties of a
     job that are necessary to prioritise them.
@@ -204,6 +398,10 @@ class ChannelJob(object):
     True
     """
 
+    __slots__ = ('db_name', 'channel', 'uuid', 'seq', 'date_created',
+                 'priority', 'eta', 'sort_key', 'pending_since', 'batch',
+                 '__weakref__')
+
     def __init__(self, db_name, channel, uuid,
                  seq, date_created, priority, eta):
         self.db_name = db_name
@@ -213,6 +411,14 @@ class ChannelJob(object):
         self.date_created = date_created
         self.priority = priority
         self.eta = eta
+        # the properties that influence the order never change
+        # for a given channel job (a new one is created when they do),
+        # so the key used by the heaps is computed once
+        self.sort_key = (not eta, eta, priority, date_created, seq)
+        # time.time() when the job has been notified pending
+        self.pending_since = None
+        # the jobs sent to Odoo in the same request, when batched
+        self.batch = None
 
     def __repr__(self):
         return "<ChannelJob %s>" % self.uuid
@@ -223,16 +429,11 @@ class ChannelJob(object):
     def __hash__(self):
         return id(self)
 
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
     def __cmp__(self, other):
-        if self.eta and not other.eta:
-            return -1
-        elif not self.eta and other.eta:
-            return 1
-        else:
-            return (cmp(self.eta, other.eta) or
-                    cmp(self.priority, other.priority) or
-                    cmp(self.date_created, other.date_created) or
-                    cmp(self.seq, other.seq))
+        return cmp(self.sort_key, other.sort_key)
 
 
 class ChannelQueue(object):
@@ -255,6 +456,12 @@ class ChannelQueue(object):
     <ChannelJob 1>
     >>> q.pop(now=12)
     <ChannelJob 3>
+
+    The eta of the next job waiting for its eta is readily available.
+
+    >>> q.add(j1)
+    >>> q.next_eta
+    10
     """
 
     def __init__(self):
@@ -267,6 +474,11 @@ class ChannelQueue(object):
     def __contains__(self, o):
         return o in self._eta_queue or o in self._queue
 
+    @property
+    def heap_size(self):
+        """ Number of jobs in the heaps, including removed ones """
+        return self._eta_queue.heap_size + self._queue.heap_size
+
     def add(self, job):
         if job.eta:
             self._eta_queue.add(job)
@@ -277,6 +489,21 @@ class ChannelQueue(object):
         self._eta_queue.remove(job)
         self._queue.remove(job)
 
+    @property
+    def next_eta(self):
+        """ The smallest eta of the jobs in the queue, or None """
+        if len(self._eta_queue):
+            return self._eta_queue[0].eta
+        return None
+
+    def peek(self, now):
+        """ Return the job :meth:`pop` would return, without removing it """
+        if len(self._eta_queue) and self._eta_queue[0].eta <= now:
+            return self._eta_queue[0]
+        elif len(self._queue):
+            return self._queue[0]
+        return None
+
     def pop(self, now):
         if len(self._eta_queue) and self._eta_queue[0].eta <= now:
             return self._eta_queue.pop()
@@ -284,6 +511,85 @@ class ChannelQueue(object):
             return self._queue.pop()
 
 
+class FairChannelQueue(object):
+    """A channel queue sharing the capacity of its channel between the
+    channels its jobs come from, according to their weight.
+
+    The origin of a job is the subchannel it comes from, or the channel
+    itself for its own jobs. Jobs are queued by origin, and the next job
+    is taken from the origin having the smallest number of running slots
+    relative to its weight. Ties are broken by the usual job order.
+
+    >>> root = Channel('root', None, capacity=4, fair=True)
+    >>> a = Channel('A', root, weight=3)
+    >>> b = Channel('B', root)
+    >>> for i in range(4):
+    ...     root._queue.add(ChannelJob(None, a, 'A%d' % i, seq=i,
+    ...                                date_created=1, priority=1, eta=None))
+    ...     root._queue.add(ChannelJob(None, b, 'B%d' % i, seq=i,
+    ...                                date_created=2, priority=1, eta=None))
+    >>> list(root.get_jobs_to_run(now=1))
+    [<ChannelJob A0>, <ChannelJob B0>, <ChannelJob A1>, <ChannelJob A2>]
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._queues = {}  # origin channel -> ChannelQueue
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def __contains__(self, o):
+        return any(o in q for q in self._queues.values())
+
+    @property
+    def heap_size(self):
+        return sum(q.heap_size for q in self._queues.values())
+
+    @property
+    def next_eta(self):
+        etas = [q.next_eta for q in self._queues.values()
+                if q.next_eta is not None]
+        return min(etas) if etas else None
+
+    def _origin(self, job):
+        origin = job.channel
+        while origin is not self.channel and origin.parent is not self.channel:
+            origin = origin.parent
+        return origin
+
+    def add(self, job):
+        origin = self._origin(job)
+        queue = self._queues.get(origin)
+        if queue is None:
+            queue = self._queues[origin] = ChannelQueue()
+        queue.add(job)
+
+    def remove(self, job):
+        queue = self._queues.get(self._origin(job))
+        if queue is not None:
+            queue.remove(job)
+
+    def pop(self, now):
+        # the jobs of a batch share a slot, count the slots by origin
+        slots = {}
+        for job in self.channel._running:
+            slots.setdefault(self._origin(job), set()).add(
+                self.channel._running.get_slot(job))
+        running = dict((origin, len(s)) for origin, s in slots.items())
+        best_key = best_queue = None
+        for origin, queue in self._queues.items():
+            job = queue.peek(now)
+            if job is None:
+                continue
+            key = (running.get(origin, 0) / origin.weight, job.sort_key)
+            if best_key is None or key < best_key:
+                best_key, best_queue = key, queue
+        if best_queue is None:
+            return None
+        return best_queue.pop(now)
+
+
 class Channel(object):
     """A channel for jobs, with a maximum capacity.
 
@@ -331,7 +637,8 @@ class Channel(object):
     without risking to overflow the system.
     """
 
-    def __init__(self, name, parent, capacity=None, sequential=False):
+    def __init__(self, name, parent, capacity=None, sequential=False,
+                 weight=1, fair=False):
         self.name = name
         self.parent = parent
         if self.parent:
@@ -339,9 +646,16 @@ class Channel(object):
         self.children = {}
         self.capacity = capacity
         self.sequential = sequential
-        self._queue = ChannelQueue()
-        self._running = SafeSet()
+        self.weight = float(weight)
+        self.fair = fair
+        self.rate_limit = None
+        self.stale_timeout = None
+        self.batch = 1
+        self._queue = FairChannelQueue(self) if fair else ChannelQueue()
+        self._running = RunningSet()
         self._failed = SafeSet()
+        # number of state transitions of jobs in the channel
+        self.transitions = dict.fromkeys(TRANSITIONS, 0)
 
     def configure(self, config):
         """ Configure a channel from a dictionary.
@@ -350,12 +664,57 @@ class Channel(object):
 
         * capacity
         * sequential
+        * weight: share of the parent channel capacity when the parent
+          channel is fair (default 1)
+        * fair: share the capacity between the subchannels according
+          to their weight, instead of strictly following the job order
+        * rate: maximum number of jobs started per period, in the
+          ``count/period`` form (see :func:`parse_rate`)
+        * stale_timeout: number of seconds after which jobs enqueued or
+          started are considered lost, and set back to pending by the
+          runner (inherited by the subchannels)
+        * batch: maximum number of jobs of the channel sent to Odoo in a
+          single request, where they run one after the other (default 1).
+          A batch uses a single slot of the capacity of the channels.
+
+        Channels must be configured before jobs are added to them.
         """
         assert self.fullname.endswith(config['name'])
         self.capacity = config.get('capacity', None)
         self.sequential = bool(config.get('sequential', False))
         if self.sequential and self.capacity != 1:
             raise ValueError("A sequential channel must have a capacity of 1")
+        try:
+            self.weight = float(config.get('weight', 1))
+        except ValueError:
+            raise ValueError("Invalid weight %s for channel %s" %
+                             (config['weight'], config['name']))
+        if self.weight <= 0:
+            raise ValueError("The weight of channel %s must be positive" %
+                             config['name'])
+        fair = bool(config.get('fair', False))
+        if fair != self.fair:
+            self.fair = fair
+            self._queue = FairChannelQueue(self) if fair else ChannelQueue()
+        rate = config.get('rate')
+        if rate:
+            self.rate_limit = TokenBucket(*parse_rate(rate))
+        else:
+            self.rate_limit = None
+        stale_timeout = config.get('stale_timeout')
+        try:
+            self.stale_timeout = int(stale_timeout) if stale_timeout else None
+        except ValueError:
+            raise ValueError("Invalid stale_timeout %s for channel %s" %
+                             (stale_timeout, config['name']))
+        try:
+            self.batch = int(config.get('batch', 1))
+        except ValueError:
+            raise ValueError("Invalid batch %s for channel %s" %
+                             (config['batch'], config['name']))
+        if self.batch < 1:
+            raise ValueError("The batch of channel %s must be positive" %
+                             config['name'])
 
     @property
     def fullname(self):
@@ -368,6 +727,60 @@ class Channel(object):
     def get_subchannel_by_name(self, subchannel_name):
         return self.children.get(subchannel_name)
 
+    def get_stale_timeout(self):
+        """ Return the stale timeout of the channel or of its parents """
+        channel = self
+        while channel:
+            if channel.stale_timeout:
+                return channel.stale_timeout
+            channel = channel.parent
+        return None
+
+    @property
+    def queue_size(self):
+        """ Number of jobs waiting in the channel queue """
+        return len(self._queue)
+
+    @property
+    def running_count(self):
+        """ Number of jobs running in the channel """
+        return len(self._running)
+
+    @property
+    def running_slot_count(self):
+        """ Number of slots of the capacity used by the running jobs """
+        return self._running.slot_count
+
+    @property
+    def failed_count(self):
+        """ Number of failed jobs in the channel """
+        return len(self._failed)
+
+    @property
+    def next_eta(self):
+        """ The smallest eta of the jobs waiting in the channel queue """
+        return self._queue.next_eta
+
+    @property
+    def rate_limit_delay(self):
+        """ Seconds until queued jobs are allowed by the rate limit.
+
+        None if the channel has no rate limit, no job waiting, or if the
+        rate limit allows jobs now (they wait for capacity then).
+        """
+        if not self.rate_limit or not len(self._queue):
+            return None
+        return self.rate_limit.wait_time() or None
+
+    @property
+    def queue_heap_size(self):
+        """ Number of entries in the channel queue heaps.
+
+        This includes removed jobs which have not been purged yet,
+        so it is always greater or equal than :attr:`queue_size`.
+        """
+        return self._queue.heap_size
+
     def __str__(self):
         capacity = u'∞' if self.capacity is None else str(self.capacity)
         return "%s(C:%s,Q:%d,R:%d,F:%d)" % (self.fullname,
@@ -390,6 +803,7 @@ class Channel(object):
         This removes it from the channel queue.
         """
         self.remove(job)
+        self.transitions[DONE] += 1
         _logger.debug("job %s marked done in channel %s",
                       job.uuid, self)
 
@@ -405,6 +819,8 @@ class Channel(object):
             self._failed.remove(job)
             if self.parent:
                 self.parent.remove(job)
+            job.batch = None
+            self.transitions[PENDING] += 1
             _logger.debug("job %s marked pending in channel %s",
                           job.uuid, self)
 
@@ -419,6 +835,7 @@ class Channel(object):
             self._failed.remove(job)
             if self.parent:
                 self.parent.set_running(job)
+            self.transitions['running'] += 1
             _logger.debug("job %s marked running in channel %s",
                           job.uuid, self)
 
@@ -430,6 +847,8 @@ class Channel(object):
             self._failed.add(job)
             if self.parent:
                 self.parent.remove(job)
+            job.batch = None
+            self.transitions[FAILED] += 1
             _logger.debug("job %s marked failed in channel %s",
                           job.uuid, self)
 
@@ -438,7 +857,12 @@ class Channel(object):
 
         This works by enqueuing jobs that are ready to run in children
         channels, then yielding jobs from the channel queue until
-        ``capacity`` jobs are marked running in the channel.
+        ``capacity`` slots are used by the jobs marked running in the
+        channel.
+
+        A channel with a ``batch`` size groups up to ``batch`` jobs of
+        the same database in a slot. The jobs grouped by a channel stay
+        together in the downstream channels, where they use a single slot.
 
         :param now: the current datetime using a type that is comparable to
                     jobs eta attribute
@@ -457,14 +881,71 @@ class Channel(object):
         if self.sequential and len(self._failed):
             return
         # yield jobs that are ready to run
-        while not self.capacity or len(self._running) < self.capacity:
+        while not self.capacity or self._running.slot_count < self.capacity:
+            if self.rate_limit and not self.rate_limit.available():
+                return
             job = self._queue.pop(now)
             if not job:
                 return
-            self._running.add(job)
-            _logger.debug("job %s marked running in channel %s",
-                          job.uuid, self)
-            yield job
+            if job.batch:
+                # batched by an upstream channel
+                jobs = [job] + [other for other in job.batch
+                                if other is not job and other in self._queue]
+                if self.rate_limit:
+                    # take the part of the batch allowed by the rate
+                    # limit, the rest stays queued as another batch
+                    count = self.rate_limit.tokens()
+                    if count < len(jobs):
+                        self._split_batch(jobs, count)
+                        jobs = jobs[:count]
+                    for other in jobs:
+                        self.rate_limit.consume()
+                for other in jobs[1:]:
+                    self._queue.remove(other)
+            else:
+                if self.rate_limit:
+                    self.rate_limit.consume()
+                jobs = [job]
+                if self.batch > 1:
+                    jobs += self._pop_batch(job, now)
+                if len(jobs) > 1:
+                    batch = tuple(jobs)
+                    for other in jobs:
+                        other.batch = batch
+            for job in jobs:
+                self._running.add(job)
+                self.transitions['running'] += 1
+                _logger.debug("job %s marked running in channel %s",
+                              job.uuid, self)
+                yield job
+
+    @staticmethod
+    def _split_batch(jobs, count):
+        """ Split a batch of jobs in two batches after ``count`` jobs """
+        for part in (jobs[:count], jobs[count:]):
+            batch = tuple(part) if len(part) > 1 else None
+            for job in part:
+                job.batch = batch
+
+    def _pop_batch(self, job, now):
+        """ Pop the jobs to run in the same request as ``job``
+
+        They must be in the same database and not be batched yet.
+        """
+        jobs = []
+        while len(jobs) < self.batch - 1:
+            if self.rate_limit and not self.rate_limit.available():
+                break
+            other = self._queue.pop(now)
+            if not other:
+                break
+            if other.db_name != job.db_name or other.batch:
+                self._queue.add(other)
+                break
+            if self.rate_limit:
+                self.rate_limit.consume()
+            jobs.append(other)
+        return jobs
 
 
 class ChannelManager(object):
@@ -524,10 +1005,52 @@ class ChannelManager(object):
     >>> cm.notify(db, 'A', 'A6', 6, 0, 5, None, 'pending')
     >>> pp(list(cm.get_jobs_to_run(now=100)))
     [<ChannelJob A6>]
+
+    The jobs of a channel with a batch size are sent to Odoo in groups
+    which use a single slot of the capacity, so a batch can be larger
+    than the capacity.
+
+    >>> cm = ChannelManager()
+    >>> cm.simple_configure('root:4,bindings:2:batch=20')
+    >>> for i in range(50):
+    ...     cm.notify(db, 'bindings', 'J%d' % i, i, 0, 10, None, 'pending')
+    >>> jobs = list(cm.get_jobs_to_run(now=100))
+    >>> len(jobs)
+    40
+    >>> sorted(set(len(job.batch) for job in jobs))
+    [20]
+    >>> bindings = cm.get_channel_by_name('bindings')
+    >>> bindings.running_count, bindings.running_slot_count
+    (40, 2)
+
+    The slot is freed when all the jobs of the batch are done.
+
+    >>> for job in jobs[1:20]:
+    ...     cm.notify(db, 'bindings', job.uuid, job.seq, 0, 10, None, 'done')
+    >>> list(cm.get_jobs_to_run(now=100))
+    []
+    >>> cm.notify(db, 'bindings', 'J0', 0, 0, 10, None, 'done')
+    >>> len(list(cm.get_jobs_to_run(now=100)))
+    10
+
+    A batch is split by the rate limit of a downstream channel, the
+    remaining jobs wait for the rate limit in the downstream channel.
+
+    >>> cm = ChannelManager()
+    >>> cm.simple_configure('root:4:rate=2/60,A:4:batch=20')
+    >>> for i in range(20):
+    ...     cm.notify(db, 'A', 'J%d' % i, i, 0, 10, None, 'pending')
+    >>> jobs = list(cm.get_jobs_to_run(now=100))
+    >>> [job.uuid for job in jobs], [len(job.batch) for job in jobs]
+    (['J0', 'J1'], [2, 2])
+    >>> cm.get_channel_by_name('root').queue_size
+    18
     """
 
     def __init__(self):
         self._jobs_by_uuid = WeakValueDictionary()
+        # db_name -> WeakValueDictionary(uuid -> job)
+        self._jobs_by_db = {}
         self._root_channel = Channel(name='root', parent=None, capacity=1)
         self._channels_by_name = WeakValueDictionary(root=self._root_channel)
 
@@ -567,6 +1090,12 @@ class ChannelManager(object):
         [{'capacity': 1, 'name': 'root'}]
         >>> pp(ChannelManager.parse_simple_config('sub:2'))
         [{'capacity': 2, 'name': 'sub'}]
+        >>> pp(ChannelManager.parse_simple_config('root:4:fair,'
+        ...                                       'sub:4:weight=3'))
+        [{'capacity': 4, 'fair': True, 'name': 'root'},
+         {'capacity': 4, 'name': 'sub', 'weight': '3'}]
+        >>> pp(ChannelManager.parse_simple_config('sub:2:rate=30/m'))
+        [{'capacity': 2, 'name': 'sub', 'rate': '30/m'}]
 
         It ignores whitespace around values, and drops empty entries which
         would be generated by trailing commas, or commented lines on the Odoo
@@ -753,6 +1282,15 @@ class ChannelManager(object):
             job = ChannelJob(db_name, channel, uuid,
                              seq, date_created, priority, eta)
             self._jobs_by_uuid[uuid] = job
+            db_jobs = self._jobs_by_db.get(db_name)
+            if db_jobs is None:
+                db_jobs = self._jobs_by_db[db_name] = WeakValueDictionary()
+            db_jobs[uuid] = job
+        if state == PENDING:
+            if job.pending_since is None:
+                job.pending_since = time.time()
+        else:
+            job.pending_since = None
         # state transitions
         if not state or state == DONE:
             job.channel.set_done(job)
@@ -770,12 +1308,111 @@ class ChannelManager(object):
         if job:
             job.channel.remove(job)
             del self._jobs_by_uuid[job.uuid]
+            db_jobs = self._jobs_by_db.get(job.db_name)
+            if db_jobs is not None:
+                db_jobs.pop(job.uuid, None)
 
     def remove_db(self, db_name):
-        for job in self._jobs_by_uuid.values():
-            if job.db_name == db_name:
-                job.channel.remove(job)
-                del self._jobs_by_uuid[job.uuid]
+        """ Remove all the jobs of a database, return their uuids.
+
+        >>> cm = ChannelManager()
+        >>> cm.notify('db1', None, 'J1', 1, 0, 10, None, 'pending')
+        >>> cm.notify('db2', None, 'J2', 2, 0, 10, None, 'pending')
+        >>> cm.count_db_jobs('db1'), cm.count_db_jobs('db2')
+        (1, 1)
+        >>> cm.remove_db('db1')
+        ['J1']
+        >>> cm.count_db_jobs('db1'), cm.count_db_jobs('db2')
+        (0, 1)
+        >>> list(cm.get_jobs_to_run(now=100))
+        [<ChannelJob J2>]
+        """
+        db_jobs = self._jobs_by_db.pop(db_name, None)
+        if not db_jobs:
+            return []
+        uuids = []
+        for job in db_jobs.values():
+            job.channel.remove(job)
+            self._jobs_by_uuid.pop(job.uuid, None)
+            uuids.append(job.uuid)
+        return uuids
+
+    def count_db_jobs(self, db_name):
+        """ Return the number of jobs of a database """
+        return len(self._jobs_by_db.get(db_name, ()))
 
     def get_jobs_to_run(self, now):
         return self._root_channel.get_jobs_to_run(now)
+
+    def get_running_jobs(self):
+        """ Return the jobs sent to Odoo to run
+
+        >>> cm = ChannelManager()
+        >>> cm.simple_configure('root:1:stale_timeout=600,A:1')
+        >>> cm.notify('db', 'A', 'A1', 1, 0, 10, None, 'started')
+        >>> [(job.uuid, job.channel.get_stale_timeout())
+        ...  for job in cm.get_running_jobs()]
+        [('A1', 600)]
+        """
+        return list(self._root_channel._running)
+
+    def get_channels(self):
+        """ Return the channels, sorted by full name """
+        return sorted(self._channels_by_name.values(),
+                      key=lambda channel: channel.fullname)
+
+    def get_db_names(self):
+        """ Return the names of the databases having jobs """
+        return list(self._jobs_by_db)
+
+    def get_wakeup_time(self, now):
+        """ Return when jobs may become ready to run without notification.
+
+        This is the smallest future eta of the jobs waiting in the channels,
+        or None if there is no such job. A job whose eta is past is either
+        returned by :meth:`get_jobs_to_run`, or waits for capacity which is
+        freed by a notification, so it is ignored.
+
+        >>> cm = ChannelManager()
+        >>> cm.simple_configure('root:4,A:1')
+        >>> cm.notify('db', 'A', 'A1', 1, 0, 10, 5, 'pending')
+        >>> cm.notify('db', 'A', 'A2', 2, 0, 10, 30, 'pending')
+        >>> cm.notify('db', None, 'R1', 3, 0, 10, 20, 'pending')
+        >>> cm.get_wakeup_time(now=0)
+        5
+        >>> list(cm.get_jobs_to_run(now=10))
+        [<ChannelJob A1>]
+        >>> cm.get_wakeup_time(now=10)
+        20
+        >>> list(cm.get_jobs_to_run(now=25))
+        [<ChannelJob R1>]
+        >>> cm.get_wakeup_time(now=25)
+        30
+        """
+        wakeup = None
+        for channel in self._channels_by_name.values():
+            eta = channel.next_eta
+            if eta is not None and eta > now:
+                if wakeup is None or eta < wakeup:
+                    wakeup = eta
+        return wakeup
+
+    def get_rate_limit_delay(self):
+        """ Seconds until a rate limited channel may run queued jobs.
+
+        None if no rate limited channel has jobs waiting.
+
+        >>> cm = ChannelManager()
+        >>> cm.simple_configure('root:4,A:4:rate=1/10')
+        >>> cm.notify('db', 'A', 'A1', 1, 0, 10, None, 'pending')
+        >>> cm.notify('db', 'A', 'A2', 2, 0, 10, None, 'pending')
+        >>> cm.get_rate_limit_delay()
+        >>> list(cm.get_jobs_to_run(now=0))
+        [<ChannelJob A1>]
+        >>> 9 < cm.get_rate_limit_delay() <= 10
+        True
+        """
+        delays = [channel.rate_limit_delay
+                  for channel in self._channels_by_name.values()]
+        delays = [delay for delay in delays if delay is not None]
+        return min(delays) if delays else None
@@ -42,11 +42,14 @@ How does it work?
 
 * It starts as a thread in the Odoo main process
 * It receives postgres NOTIFY messages each time jobs are
-  added or updated in the queue_job table.
+  added, removed or rescheduled in the queue_job table. The
+  notifications carry the state, channel, priority and eta of the
+  jobs, so the runner does not need to read them.
 * It maintains an in-memory priority queue of jobs that
   is populated from the queue_job tables in all databases.
 * It does not run jobs itself, but asks Odoo to run them through an
-  anonymous ``/connector/runjob`` HTTP request. [1]_
+  anonymous ``/connector/runjob`` HTTP request, or ``/connector/runjobs``
+  for several jobs of channels with a ``batch`` option. [1]_
 
 How to use it?
 --------------
@@ -55,9 +58,21 @@ How to use it?
 
   - ``ODOO_CONNECTOR_CHANNELS=root:4`` (or any other channels configuration)
   - optional if ``xmlrpc_port`` is not set: ``ODOO_CONNECTOR_PORT=8069``
+  - optional: ``ODOO_CONNECTOR_DISPATCH_WORKERS=8``, the maximum number
+    of concurrent HTTP requests sent to Odoo to run jobs
+  - optional: ``ODOO_CONNECTOR_METRICS_PORT=9187`` to expose the runner
+    metrics in the Prometheus text format on ``/metrics``, and
+    ``ODOO_CONNECTOR_METRICS_INTERFACE`` (default ``127.0.0.1``)
+  - optional: ``ODOO_CONNECTOR_ENDPOINTS=odoo1:8069,odoo2:8069``, the
+    Odoo HTTP servers which run the jobs, instead of localhost on the
+    port above. Each job is sent to the endpoint with the least jobs in
+    flight, and endpoints failing to answer are ignored for
+    ``ENDPOINT_COOLDOWN`` seconds.
 
-* Or alternatively, set ``channels = root:4`` in the ``[options-connector]``
-  section of the odoo configuration file.
+* Or alternatively, set ``channels = root:4`` (and optionally
+  ``dispatch_workers = 8``, ``metrics_port = 9187``,
+  ``metrics_interface = 127.0.0.1``, ``endpoints = odoo1:8069,odoo2:8069``)
+  in the ``[options-connector]`` section of the odoo configuration file.
 
 * Start Odoo with ``--load=web,web_kanban,connector``
   and ``--workers`` greater than 1. [2]_
@@ -81,11 +96,24 @@ How to use it?
 * Tip: to enable debug logging for the connector, use
   ``--log-handler=openerp.addons.connector:DEBUG``
 
+* Several Odoo nodes sharing the same databases can run the runner:
+  a database is handled by one runner at a time, which holds a postgres
+  advisory lock on it. The runners of the other nodes stand by and take
+  over the database within ``STANDBY_RETRY_INTERVAL`` seconds when the
+  active runner stops or loses its connection. When there are several
+  databases, they are therefore spread among the nodes. The jobs which
+  were running on a lost node are only requeued if their channel has a
+  ``stale_timeout``.
+
 Caveat
 ------
 
-* After creating a new database or installing connector on an
-  existing database, Odoo must be restarted for the runner to detect it.
+* After creating a new database, the runner detects it within
+  ``DB_DISCOVERY_INTERVAL`` seconds (one minute). The databases without
+  connector are checked again every ``NO_CONNECTOR_RECHECK_INTERVAL``
+  seconds (ten minutes), so installing connector on an existing database
+  is detected within ten minutes. Uninstalling connector is detected
+  within one minute.
 
 * When Odoo shuts down normally, it waits for running jobs to finish.
   However, when the Odoo server crashes or is otherwise force-stopped,
@@ -94,9 +122,12 @@ Caveat
   ``started`` or ``enqueued`` state after the Odoo server is halted.
   Since the runner has no way to know if they are actually running or
   not, and does not know for sure if it is safe to restart the jobs,
-  it does not attempt to restart them automatically. Such stale jobs
-  therefore fill the running queue and prevent other jobs to start.
-  You must therefore requeue them manually, either from the Jobs view,
+  it does not attempt to restart them automatically, unless the
+  ``stale_timeout`` option is set on their channel (or a parent channel,
+  eg ``root:4:stale_timeout=3600``): jobs enqueued or started for longer
+  than this number of seconds are then set back to pending by the runner.
+  Otherwise such stale jobs fill the running queue and prevent other jobs
+  to start. You must then requeue them manually, either from the Jobs view,
   or by running the following SQL statement *before starting Odoo*:
 
 .. code-block:: sql
@@ -112,9 +143,12 @@ Caveat
        of running Odoo is obviously not for production purposes.
 """
 
+import BaseHTTPServer
 from contextlib import closing
+import json
 import logging
 import os
+import Queue
 import re
 import select
 import threading
@@ -127,15 +161,32 @@ import requests
 import openerp
 from openerp.tools import config
 
-from .channels import ChannelManager, PENDING, ENQUEUED, NOT_DONE
+from .channels import (ChannelManager, PENDING, ENQUEUED, STARTED, DONE,
+                       NOT_DONE)
 
 SELECT_TIMEOUT = 60
 ERROR_RECOVERY_DELAY = 5
+# seconds between two checks for new or removed databases
+DB_DISCOVERY_INTERVAL = 60
+NO_CONNECTOR_RECHECK_INTERVAL = 600
+# seconds between two searches for stale jobs
+REAPER_INTERVAL = 60
+# seconds between two attempts to take over the databases handled
+# by the runner of another node
+STANDBY_RETRY_INTERVAL = 10
+# key of the postgres advisory lock held by the runner handling a database
+ADVISORY_LOCK_KEY = 7131
+# default number of threads sending the HTTP requests to run jobs
+DISPATCH_WORKERS = 8
+# seconds during which an endpoint is not used after a failed request
+ENDPOINT_COOLDOWN = 30
+# maximum number of uuids passed to a single ``uuid = ANY(%s)`` query
+SELECT_CHUNK_SIZE = 1000
+# number of jobs fetched at once when loading the jobs of a database
+LOAD_BATCH_SIZE = 10000
 
 _logger = logging.getLogger(__name__)
 
-sessions = {}
-
 
 # Unfortunately, it is not possible to extend the Odoo
 # server command line arguments, so we resort to environment variables
@@ -155,35 +206,253 @@ def _channels():
     )
 
 
-def _async_http_get(port, db_name, job_uuid):
-    if not sessions.get(db_name):
-        sessions[db_name] = requests.Session()
-    session = sessions[db_name]
-    if not session.cookies:
-        # obtain an anonymous session
-        _logger.info("obtaining an anonymous session for the job runner")
-        url = 'http://localhost:%s/web/login?db=%s' % (port, db_name)
-        response = session.get(url, timeout=30)
-        response.raise_for_status()
-
-    # Method to set failed job (due to timeout, etc) as pending,
-    # to avoid keeping it as enqueued.
-    def set_job_pending():
-        conn = psycopg2.connect(openerp.sql_db.dsn(db_name)[1])
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        with closing(conn.cursor()) as cr:
-            cr.execute(
-                "UPDATE queue_job SET state=%s, "
-                "date_enqueued=NULL, date_started=NULL "
-                "WHERE uuid=%s and state=%s", (PENDING, job_uuid, ENQUEUED)
-            )
-
-    # TODO: better way to HTTP GET asynchronously (grequest, ...)?
-    #       if this was python3 I would be doing this with
-    #       asyncio, aiohttp and aiopg
-    def urlopen():
-        url = ('http://localhost:%s/connector/runjob?db=%s&job_uuid=%s' %
-               (port, db_name, job_uuid))
+def _dispatch_workers():
+    # environment takes precedence over config file if set.
+    env_workers = os.environ.get('ODOO_CONNECTOR_DISPATCH_WORKERS', None)
+    workers = (
+        env_workers if env_workers is not None
+        else config.misc.get("options-connector", {}).get(
+            "dispatch_workers")
+    )
+    return int(workers) if workers else DISPATCH_WORKERS
+
+
+def _endpoints():
+    # environment takes precedence over config file if set.
+    env_endpoints = os.environ.get('ODOO_CONNECTOR_ENDPOINTS', None)
+    endpoints = (
+        env_endpoints if env_endpoints is not None
+        else config.misc.get("options-connector", {}).get("endpoints")
+    )
+    return parse_endpoints(endpoints) if endpoints else None
+
+
+def parse_endpoints(endpoints_string):
+    """ Parse a comma separated list of Odoo HTTP endpoints
+
+    Endpoints are urls, or ``host:port`` for plain HTTP.
+
+    >>> parse_endpoints('odoo1:8069, https://odoo2/,odoo3:8069')
+    ['http://odoo1:8069', 'https://odoo2', 'http://odoo3:8069']
+    """
+    endpoints = []
+    for endpoint in endpoints_string.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        if '://' not in endpoint:
+            endpoint = 'http://' + endpoint
+        endpoints.append(endpoint.rstrip('/'))
+    return endpoints
+
+
+def _metrics_address():
+    # environment takes precedence over config file if set.
+    options = config.misc.get("options-connector", {})
+    port = os.environ.get('ODOO_CONNECTOR_METRICS_PORT',
+                          options.get('metrics_port'))
+    if not port:
+        return None
+    interface = os.environ.get('ODOO_CONNECTOR_METRICS_INTERFACE',
+                               options.get('metrics_interface'))
+    return (interface or '127.0.0.1', int(port))
+
+
+class Endpoint(object):
+    """ An Odoo HTTP server the jobs are sent to """
+
+    def __init__(self, url):
+        self.url = url
+        # uuids of the jobs sent to this endpoint which are not done yet
+        self.in_flight = set()
+        self.ejected_until = 0
+        self.failures = 0
+
+    def is_healthy(self, now):
+        return self.ejected_until <= now
+
+
+class HttpDispatcher(object):
+    """ Ask Odoo to run jobs through a bounded pool of HTTP threads.
+
+    Jobs to run are put in a queue which is consumed by a fixed
+    number of daemon threads. Each endpoint and database has its own
+    ``requests`` session, so the HTTP connections are kept alive and
+    reused between jobs instead of being opened for every job.
+
+    Each request is sent to the healthy endpoint with the least jobs in
+    flight. An endpoint which fails to answer is ejected for
+    ``ENDPOINT_COOLDOWN`` seconds, then tried again. The jobs are in
+    flight until the runner calls :meth:`release` for them.
+
+    >>> dispatcher = HttpDispatcher(8069, endpoints=['http://a:80',
+    ...                                              'http://b:80'])
+    >>> dispatcher._acquire_endpoint(['A1', 'A2']).url
+    'http://a:80'
+    >>> dispatcher._acquire_endpoint(['A3']).url
+    'http://b:80'
+    >>> dispatcher._acquire_endpoint(['A4']).url
+    'http://b:80'
+    >>> dispatcher.release(['A1', 'A2'])
+    >>> dispatcher._acquire_endpoint(['A5']).url
+    'http://a:80'
+    >>> dispatcher._eject(dispatcher.endpoints[0])
+    >>> dispatcher._acquire_endpoint(['A6']).url
+    'http://b:80'
+    """
+
+    def __init__(self, port, workers=DISPATCH_WORKERS, wakeup=None,
+                 endpoints=None):
+        self.port = port
+        self.endpoints = [Endpoint(url) for url in
+                          endpoints or ['http://localhost:%s' % port]]
+        self._endpoint_by_uuid = {}
+        self._endpoints_lock = threading.Lock()
+        self.workers = workers
+        # called when jobs could not be dispatched
+        self.wakeup = wakeup
+        self._queue = Queue.Queue()
+        self._failed = Queue.Queue()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._threads = []
+        # number of HTTP requests which failed (timeouts and errors
+        # returned by the jobs excepted)
+        self.errors = 0
+        self._errors_lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """ Number of jobs waiting for a free dispatch thread """
+        return self._queue.qsize()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='connector-dispatch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def dispatch(self, db_name, job_uuids):
+        """ Enqueue an asynchronous HTTP request to run jobs
+
+        Several jobs are run one after the other by the same request.
+        """
+        self._queue.put((db_name, job_uuids))
+        _logger.debug("%d jobs waiting for dispatch", self.queue_depth)
+
+    def release(self, uuids):
+        """ Tell the jobs are not running on their endpoint anymore """
+        with self._endpoints_lock:
+            for uuid in uuids:
+                endpoint = self._endpoint_by_uuid.pop(uuid, None)
+                if endpoint is not None:
+                    endpoint.in_flight.discard(uuid)
+
+    def _acquire_endpoint(self, job_uuids):
+        now = time.time()
+        with self._endpoints_lock:
+            endpoints = [endpoint for endpoint in self.endpoints
+                         if endpoint.is_healthy(now)]
+            if not endpoints:
+                # all the endpoints failed recently, try the one which
+                # has been ejected for the longest time
+                endpoints = [min(self.endpoints,
+                                 key=lambda e: e.ejected_until)]
+            endpoint = min(endpoints, key=lambda e: len(e.in_flight))
+            for job_uuid in job_uuids:
+                endpoint.in_flight.add(job_uuid)
+                self._endpoint_by_uuid[job_uuid] = endpoint
+            return endpoint
+
+    def _eject(self, endpoint):
+        with self._endpoints_lock:
+            endpoint.failures += 1
+            endpoint.ejected_until = time.time() + ENDPOINT_COOLDOWN
+        _logger.warning("endpoint %s ejected for %d seconds",
+                        endpoint.url, ENDPOINT_COOLDOWN)
+
+    def _succeed(self, endpoint):
+        if endpoint.failures:
+            with self._endpoints_lock:
+                endpoint.failures = 0
+                endpoint.ejected_until = 0
+            _logger.info("endpoint %s is back", endpoint.url)
+
+    def pop_failed(self):
+        """ Return the ``(db_name, job_uuid)`` which could not be dispatched
+
+        These jobs must be set back to pending, to avoid keeping them
+        enqueued. This is left to the runner which owns the database
+        connections.
+        """
+        failed = []
+        while True:
+            try:
+                failed.append(self._failed.get_nowait())
+            except Queue.Empty:
+                return failed
+
+    def _set_failed(self, db_name, job_uuids):
+        for job_uuid in job_uuids:
+            self._failed.put((db_name, job_uuid))
+        if self.wakeup:
+            self.wakeup()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._http_get(*item)
+            except:
+                _logger.exception("exception while dispatching jobs %s "
+                                  "on db %s", item[1], item[0])
+
+    def _get_session(self, endpoint, db_name):
+        key = (endpoint.url, db_name)
+        with self._sessions_lock:
+            if key not in self._sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[key] = (session, threading.Lock())
+            session, login_lock = self._sessions[key]
+        # log in outside of the shared lock, so a slow endpoint or
+        # database does not block the dispatch of the other jobs
+        with login_lock:
+            if not session.cookies:
+                # obtain an anonymous session
+                _logger.info("obtaining an anonymous session "
+                             "for the job runner on %s", endpoint.url)
+                url = '%s/web/login?db=%s' % (endpoint.url, db_name)
+                response = session.get(url, timeout=30)
+                response.raise_for_status()
+        return session
+
+    def _http_get(self, db_name, job_uuids):
+        endpoint = self._acquire_endpoint(job_uuids)
+        if len(job_uuids) == 1:
+            url = ('%s/connector/runjob?db=%s&job_uuid=%s' %
+                   (endpoint.url, db_name, job_uuids[0]))
+        else:
+            url = ('%s/connector/runjobs?db=%s&job_uuids=%s' %
+                   (endpoint.url, db_name, ','.join(job_uuids)))
+        try:
+            session = self._get_session(endpoint, db_name)
+        except Exception:
+            _logger.exception("could not log in on %s", endpoint.url)
+            self._endpoint_failed(endpoint, db_name, job_uuids)
+            return
         try:
             # we are not interested in the result, so we set a short timeout
             # but not too short so we trap and log hard configuration errors
@@ -193,15 +462,96 @@ def _async_http_get(port, db_name, job_uuid):
             # for HTTP Response codes between 400 and 500 or a Server Error
             # for codes between 500 and 600
             response.raise_for_status()
+            self._succeed(endpoint)
         except requests.Timeout:
-            set_job_pending()
-        except:
+            # the job is running, or will be set back to pending; the jobs
+            # of a batch are left enqueued, they wait for their turn
+            if len(job_uuids) == 1:
+                self._set_failed(db_name, job_uuids)
+        except requests.HTTPError as err:
+            # the endpoint answered: a job which fails quickly returns
+            # an error, its failure is stored on the job
+            _logger.warning("GET %s: %s", url, err)
+            self._succeed(endpoint)
+            self._set_failed(db_name, job_uuids)
+        except requests.ConnectionError:
+            _logger.exception("exception in GET %s", url)
+            session.cookies.clear()
+            self._endpoint_failed(endpoint, db_name, job_uuids)
+        except Exception:
             _logger.exception("exception in GET %s", url)
+            with self._errors_lock:
+                self.errors += 1
             session.cookies.clear()
-            set_job_pending()
-    thread = threading.Thread(target=urlopen)
-    thread.daemon = True
-    thread.start()
+            self._set_failed(db_name, job_uuids)
+
+    def _endpoint_failed(self, endpoint, db_name, job_uuids):
+        """ The endpoint could not run the jobs, try them elsewhere """
+        with self._errors_lock:
+            self.errors += 1
+        self.release(job_uuids)
+        self._eject(endpoint)
+        self._set_failed(db_name, job_uuids)
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve the runner metrics on ``/metrics`` """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        # built by the runner thread, which owns the channels
+        body = self.server.runner.metrics
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("metrics request: " + format, *args)
+
+
+def parse_payload(payload):
+    """ Parse the payload of a notification sent by the queue_job trigger
+
+    Return a tuple ``(uuid, job_data)`` where ``job_data`` is the
+    arguments of :meth:`ChannelManager.notify` following the database
+    name, or None when the job has been removed.
+
+    >>> uuid, job_data = parse_payload(
+    ...     '{"uuid":"abc","channel":"root.A","seq":3,'
+    ...     '"date_created":"2015-01-01 10:00:00","priority":10,'
+    ...     '"eta":null,"state":"pending"}')
+    >>> job_data
+    (u'root.A', u'abc', 3, u'2015-01-01 10:00:00', 10, None, u'pending')
+    >>> parse_payload('{"uuid":"abc","removed":true}')
+    (u'abc', None)
+
+    Older triggers only send the uuid, the job must then be read, which
+    is told by a ``job_data`` of ``False``:
+
+    >>> parse_payload('abc')
+    ('abc', False)
+
+    Jobs inserted in bulk are notified with the range of their ids, which
+    is returned instead of the job data, without uuid:
+
+    >>> parse_payload('{"id_range": [10, 2000]}')
+    (None, (10, 2000))
+    """
+    if not payload.startswith('{'):
+        return payload, False
+    values = json.loads(payload)
+    if 'id_range' in values:
+        return None, tuple(values['id_range'])
+    uuid = values['uuid']
+    if values.get('removed'):
+        return uuid, None
+    return uuid, (values['channel'], uuid, values['seq'],
+                  values['date_created'], values['priority'],
+                  values['eta'], values['state'])
 
 
 class Database(object):
@@ -211,9 +561,16 @@ class Database(object):
         self.conn = psycopg2.connect(openerp.sql_db.dsn(db_name)[1])
         self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         self.has_connector = self._has_connector()
+        self.is_active = False
         if self.has_connector:
             self.has_channel = self._has_queue_job_column('channel')
-            self._initialize()
+            self.has_identity_key = self._has_queue_job_column(
+                'identity_key')
+            # only one runner of the cluster handles the database, the
+            # lock is released when its connection is closed or lost
+            self.is_active = self._try_lock()
+            if self.is_active:
+                self._initialize()
 
     def close(self):
         try:
@@ -236,6 +593,10 @@ class Database(object):
                     raise
             return cr.fetchone()
 
+    def check_connector(self):
+        """ Return whether connector is still installed """
+        return bool(self._has_connector())
+
     def _has_queue_job_column(self, column):
         if not self.has_connector:
             return False
@@ -245,31 +606,85 @@ class Database(object):
                        ('queue_job', column))
             return cr.fetchone()
 
+    def _try_lock(self):
+        with closing(self.conn.cursor()) as cr:
+            cr.execute("SELECT pg_try_advisory_lock(%s)",
+                       (ADVISORY_LOCK_KEY,))
+            return cr.fetchone()[0]
+
     def _initialize(self):
+        channel = 'NEW.channel' if self.has_channel else 'NULL'
         with closing(self.conn.cursor()) as cr:
-            # this is the trigger that sends notifications when jobs change
+            # this is the trigger that sends notifications when jobs change;
+            # the payload carries the fields the channels need, so the
+            # runner does not have to read the jobs (see parse_payload),
+            # timestamps are cast to text to get the same format as
+            # when they are read
             cr.execute("""
                 DROP TRIGGER IF EXISTS queue_job_notify ON queue_job;
+                DROP TRIGGER IF EXISTS queue_job_notify_update ON queue_job;
 
                 CREATE OR REPLACE
                     FUNCTION queue_job_notify() RETURNS trigger AS $$
                 BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        -- jobs inserted in bulk are notified at once,
+                        -- current_setting fails when it has never been set
+                        BEGIN
+                            IF current_setting('connector.suppress_notify')
+                                    = 'on' THEN
+                                RETURN NULL;
+                            END IF;
+                        EXCEPTION WHEN undefined_object THEN
+                            NULL;
+                        END;
+                    END IF;
                     IF TG_OP = 'DELETE' THEN
                         IF OLD.state != 'done' THEN
-                            PERFORM pg_notify('connector', OLD.uuid);
+                            PERFORM pg_notify('connector', (
+                                SELECT row_to_json(job)::text
+                                FROM (SELECT OLD.uuid AS uuid,
+                                             true AS removed) job
+                            ));
                         END IF;
                     ELSE
-                        PERFORM pg_notify('connector', NEW.uuid);
+                        PERFORM pg_notify('connector', (
+                            SELECT row_to_json(job)::text
+                            FROM (SELECT NEW.uuid AS uuid,
+                                         %(channel)s AS channel,
+                                         NEW.id AS seq,
+                                         NEW.date_created::text
+                                             AS date_created,
+                                         NEW.priority AS priority,
+                                         NEW.eta::text AS eta,
+                                         NEW.state AS state) job
+                        ));
                     END IF;
                     RETURN NULL;
                 END;
                 $$ LANGUAGE plpgsql;
 
                 CREATE TRIGGER queue_job_notify
-                    AFTER INSERT OR UPDATE OR DELETE
+                    AFTER INSERT OR DELETE
                     ON queue_job
                     FOR EACH ROW EXECUTE PROCEDURE queue_job_notify();
-            """)
+
+                -- updates of the result, exc_info, ... are not notified
+                CREATE TRIGGER queue_job_notify_update
+                    AFTER UPDATE
+                    ON queue_job
+                    FOR EACH ROW
+                    WHEN (OLD.state IS DISTINCT FROM NEW.state OR
+                          OLD.priority IS DISTINCT FROM NEW.priority OR
+                          OLD.eta IS DISTINCT FROM NEW.eta%(channel_changed)s)
+                    EXECUTE PROCEDURE queue_job_notify();
+            """ % {
+                'channel': channel,
+                'channel_changed': (
+                    ' OR\n                          '
+                    'OLD.channel IS DISTINCT FROM NEW.channel'
+                    if self.has_channel else ''),
+            })
             cr.execute("LISTEN connector")
 
     def select_jobs(self, where, args):
@@ -282,23 +697,172 @@ class Database(object):
             cr.execute(query, args)
             return list(cr.fetchall())
 
-    def set_job_enqueued(self, uuid):
+    def iter_not_done_jobs(self, batch_size=LOAD_BATCH_SIZE):
+        """ Stream the jobs which are not done, in batches.
+
+        A server side cursor is used on a dedicated connection, so the
+        backlog is never loaded in memory at once. Running jobs come
+        first, so the channels know their used capacity, then the jobs
+        are ordered by priority so the most important ones can be
+        dispatched before the backlog is fully loaded.
+
+        Return an iterator of lists of rows like :meth:`select_jobs`.
+        """
+        query = ("SELECT %s, uuid, id as seq, date_created, "
+                 "priority, eta, state "
+                 "FROM queue_job WHERE state in %%s "
+                 "ORDER BY state NOT IN %%s, priority, date_created, id" %
+                 ('channel' if self.has_channel else 'NULL',))
+        conn = psycopg2.connect(openerp.sql_db.dsn(self.db_name)[1])
+        try:
+            # named cursors need a transaction
+            with closing(conn.cursor('connector_runner_load')) as cr:
+                cr.itersize = batch_size
+                cr.execute(query, (NOT_DONE, (ENQUEUED, STARTED)))
+                while True:
+                    job_datas = cr.fetchmany(batch_size)
+                    if not job_datas:
+                        break
+                    yield job_datas
+        finally:
+            conn.close()
+
+    def select_jobs_by_uuids(self, uuids):
+        """ Select jobs by uuid, in chunks of ``SELECT_CHUNK_SIZE``.
+
+        Return an iterator of the same rows as :meth:`select_jobs`.
+        """
+        uuids = list(uuids)
+        for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+            chunk = uuids[i:i + SELECT_CHUNK_SIZE]
+            for job_data in self.select_jobs('uuid = ANY(%s)', (chunk,)):
+                yield job_data
+
+    def set_jobs_enqueued(self, uuids):
+        """ Mark pending jobs as enqueued, in chunks of ``SELECT_CHUNK_SIZE``.
+
+        Return the set of uuids of the jobs that have actually been
+        updated. Jobs that are not pending anymore in the database
+        (done, removed, ...) are left untouched: the notifications of
+        their changes will fix the state in the channels.
+        """
+        uuids = list(uuids)
+        updated = set()
+        with closing(self.conn.cursor()) as cr:
+            for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+                chunk = uuids[i:i + SELECT_CHUNK_SIZE]
+                cr.execute("UPDATE queue_job SET state=%s, "
+                           "date_enqueued=date_trunc("
+                           "    'seconds', now() at time zone 'utc') "
+                           "WHERE uuid = ANY(%s) AND state=%s "
+                           "RETURNING uuid",
+                           (ENQUEUED, chunk, PENDING))
+                updated.update(uuid for uuid, in cr.fetchall())
+        return updated
+
+    def set_jobs_pending(self, uuids, states, older_than=None):
+        """ Set jobs back to pending, in chunks of ``SELECT_CHUNK_SIZE``.
+
+        Only the jobs in one of ``states`` are updated and, when
+        ``older_than`` is given, only the jobs enqueued or started for more
+        than ``older_than`` seconds. Return the set of uuids of the jobs
+        that have been updated.
+
+        Only one job by identity key can be pending: the jobs having the
+        identity key of a pending job, or of another job of the chunk, are
+        canceled instead.
+        """
+        where = "uuid = ANY(%s) AND state IN %s "
+        args = (None, tuple(states))
+        if older_than:
+            where += ("AND COALESCE(date_started, date_enqueued) < "
+                      "    now() at time zone 'utc' "
+                      "    - %s * interval '1 second' ")
+            args += (older_than,)
+        if self.has_identity_key:
+            query = ("WITH candidates AS ("
+                     "    SELECT id, identity_key, row_number() OVER ("
+                     "        PARTITION BY identity_key ORDER BY id"
+                     "    ) AS rank "
+                     "    FROM queue_job WHERE " + where +
+                     "), superseded AS ("
+                     "    UPDATE queue_job SET state=%s, active=false, "
+                     "    date_enqueued=NULL, date_started=NULL, "
+                     "    date_done=now() at time zone 'utc', result=%s "
+                     "    FROM candidates "
+                     "    WHERE queue_job.id = candidates.id "
+                     "    AND candidates.identity_key IS NOT NULL "
+                     "    AND (candidates.rank > 1 OR EXISTS ("
+                     "        SELECT 1 FROM queue_job pending "
+                     "        WHERE pending.identity_key = "
+                     "            candidates.identity_key "
+                     "        AND pending.state = %s)) "
+                     "    RETURNING queue_job.id"
+                     ") "
+                     "UPDATE queue_job SET state=%s, "
+                     "date_enqueued=NULL, date_started=NULL "
+                     "FROM candidates "
+                     "WHERE queue_job.id = candidates.id "
+                     "AND candidates.id NOT IN (SELECT id FROM superseded) "
+                     "RETURNING queue_job.uuid")
+            args += (DONE, 'Superseded by an identical pending job.',
+                     PENDING, PENDING)
+        else:
+            query = ("UPDATE queue_job SET state=%s, "
+                     "date_enqueued=NULL, date_started=NULL "
+                     "WHERE " + where + "RETURNING uuid")
+            args = (PENDING,) + args
+        chunk_index = args.index(None)
+        uuids = list(uuids)
+        updated = set()
         with closing(self.conn.cursor()) as cr:
-            cr.execute("UPDATE queue_job SET state=%s, "
-                       "date_enqueued=date_trunc('seconds', "
-                       "                         now() at time zone 'utc') "
-                       "WHERE uuid=%s",
-                       (ENQUEUED, uuid))
+            for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+                chunk = uuids[i:i + SELECT_CHUNK_SIZE]
+                cr.execute(query, args[:chunk_index] + (chunk,) +
+                           args[chunk_index + 1:])
+                updated.update(uuid for uuid, in cr.fetchall())
+        return updated
 
 
 class ConnectorRunner(object):
 
-    def __init__(self, port=8069, channel_config_string='root:1'):
+    def __init__(self, port=8069, channel_config_string='root:1',
+                 dispatch_workers=DISPATCH_WORKERS, metrics_address=None,
+                 endpoints=None):
         self.port = port
+        self.dispatcher = HttpDispatcher(port, dispatch_workers,
+                                         wakeup=self.wakeup,
+                                         endpoints=endpoints)
+        self.metrics_address = metrics_address
+        self._metrics_server = None
+        # text of the metrics served by the metrics server thread,
+        # replaced by the runner thread after each pass
+        self.metrics = ''
         self.channel_manager = ChannelManager()
         self.channel_manager.simple_configure(channel_config_string)
         self.db_by_name = {}
+        # number of notifications that did not cost a query because
+        # they were coalesced with another notification for the same job
+        self.coalesced_notifications = 0
+        self.dispatched = 0
+        # seconds between the pending notification and the dispatch
+        # of the jobs without eta
+        self.dispatch_latency_sum = 0.
+        self.dispatch_latency_count = 0
+        self._last_discovery = 0
+        # db_name -> when the databases without connector were checked
+        self._no_connector_db_names = {}
+        self._last_reap = time.time()
+        # databases handled by the runner of another node
+        self.standby_db_names = set()
+        self._last_standby_retry = 0
+        # number of stale jobs set back to pending
+        self.reaped = 0
+        # db_name -> uuids of the jobs not dispatched which could not be
+        # set back to pending, retried on the next pass
+        self._not_requeued = {}
         self._stop = False
+        # the select() in wait_notification also waits on this pipe
         self._stop_pipe = os.pipe()
 
     def get_db_names(self):
@@ -315,46 +879,282 @@ class ConnectorRunner(object):
         for db_name, db in self.db_by_name.items():
             try:
                 if remove_jobs:
-                    self.channel_manager.remove_db(db_name)
+                    self.dispatcher.release(
+                        self.channel_manager.remove_db(db_name))
                 db.close()
             except:
                 _logger.warning('error closing database %s',
                                 db_name, exc_info=True)
         self.db_by_name = {}
 
+    def add_database(self, db_name):
+        db = Database(db_name)
+        if not db.has_connector:
+            _logger.debug('connector is not installed for db %s', db_name)
+            self.standby_db_names.discard(db_name)
+            self._no_connector_db_names[db_name] = time.time()
+            db.close()
+        elif not db.is_active:
+            if db_name not in self.standby_db_names:
+                _logger.info('connector runner of another node is active '
+                             'for db %s, standing by', db_name)
+                self.standby_db_names.add(db_name)
+            db.close()
+        else:
+            self.standby_db_names.discard(db_name)
+            self._no_connector_db_names.pop(db_name, None)
+            self.db_by_name[db_name] = db
+            self.load_jobs(db)
+            _logger.info('connector runner ready for db %s', db_name)
+
+    def remove_database(self, db_name):
+        db = self.db_by_name.pop(db_name)
+        # the runner does not know when the jobs are done anymore
+        self.dispatcher.release(self.channel_manager.remove_db(db_name))
+        db.close()
+
     def initialize_databases(self):
         for db_name in self.get_db_names():
-            db = Database(db_name)
-            if not db.has_connector:
-                _logger.debug('connector is not installed for db %s', db_name)
-            else:
-                self.db_by_name[db_name] = db
-                for job_data in db.select_jobs('state in %s', (NOT_DONE,)):
-                    self.channel_manager.notify(db_name, *job_data)
-                _logger.info('connector runner ready for db %s', db_name)
+            self.add_database(db_name)
+        self._last_discovery = time.time()
+
+    def discover_databases(self):
+        """ Add new databases and remove the ones which disappeared or
+        where connector has been uninstalled.
+
+        Databases are added or removed individually, so the channels
+        keep the jobs of the other databases. The databases without
+        connector are only checked every ``NO_CONNECTOR_RECHECK_INTERVAL``
+        seconds.
+        """
+        now = self._last_discovery = time.time()
+        db_names = set(self.get_db_names())
+        self.standby_db_names &= db_names
+        for db_name in set(self.db_by_name) - db_names:
+            _logger.info('removing db %s from the connector runner', db_name)
+            self.remove_database(db_name)
+        for db_name, db in self.db_by_name.items():
+            try:
+                has_connector = db.check_connector()
+            except Exception:
+                _logger.warning('error checking database %s',
+                                db_name, exc_info=True)
+                has_connector = False
+            if not has_connector:
+                _logger.info('removing db %s from the connector runner, '
+                             'connector is not installed', db_name)
+                self.remove_database(db_name)
+        for db_name, checked in self._no_connector_db_names.items():
+            if db_name not in db_names:
+                del self._no_connector_db_names[db_name]
+            elif now - checked < NO_CONNECTOR_RECHECK_INTERVAL:
+                db_names.discard(db_name)
+        self._add_databases(db_names - set(self.db_by_name))
+
+    def retry_standby_databases(self):
+        """ Take over the databases whose active runner has stopped """
+        self._last_standby_retry = time.time()
+        self._add_databases(set(self.standby_db_names))
+
+    def _add_databases(self, db_names):
+        for db_name in db_names:
+            try:
+                self.add_database(db_name)
+            except Exception:
+                # do not interrupt the other databases for a database
+                # we cannot connect to, it will be retried later
+                _logger.warning('error adding database %s',
+                                db_name, exc_info=True)
+                if db_name in self.db_by_name:
+                    self.remove_database(db_name)
+
+    def load_jobs(self, db):
+        """ Load the jobs which are not done from a database.
+
+        The jobs are loaded in batches and jobs are dispatched after
+        each batch, so the runner starts working before a large
+        backlog is fully loaded.
+        """
+        count = 0
+        for job_datas in db.iter_not_done_jobs():
+            if self._stop:
+                break
+            for job_data in job_datas:
+                self.channel_manager.notify(db.db_name, *job_data)
+            count += len(job_datas)
+            _logger.info('loaded %d jobs for db %s', count, db.db_name)
+            self.run_jobs()
 
     def run_jobs(self):
         now = openerp.fields.Datetime.now()
+        jobs_by_db = {}
         for job in self.channel_manager.get_jobs_to_run(now):
             if self._stop:
                 break
-            _logger.info("asking Odoo to run job %s on db %s",
-                         job.uuid, job.db_name)
-            self.db_by_name[job.db_name].set_job_enqueued(job.uuid)
-            _async_http_get(self.port, job.db_name, job.uuid)
+            jobs_by_db.setdefault(job.db_name, []).append(job)
+        for db_name, jobs in jobs_by_db.items():
+            enqueued = self.db_by_name[db_name].set_jobs_enqueued(
+                job.uuid for job in jobs)
+            # the jobs batched by the channels share a request
+            batches = {}
+            for job in jobs:
+                if job.uuid not in enqueued:
+                    _logger.debug("job %s on db %s is not pending anymore, "
+                                  "not running it", job.uuid, db_name)
+                    continue
+                if job.batch:
+                    batches.setdefault(job.batch[0], []).append(job.uuid)
+                else:
+                    _logger.info("asking Odoo to run job %s on db %s",
+                                 job.uuid, db_name)
+                    self.dispatcher.dispatch(db_name, [job.uuid])
+                self.dispatched += 1
+                if job.pending_since is not None and not job.eta:
+                    self.dispatch_latency_sum += (time.time() -
+                                                  job.pending_since)
+                    self.dispatch_latency_count += 1
+            for batch in batches.values():
+                self._dispatch_batch(db_name, batch)
+
+    def _dispatch_batch(self, db_name, job_uuids):
+        _logger.info("asking Odoo to run jobs %s on db %s",
+                     ', '.join(job_uuids), db_name)
+        self.dispatcher.dispatch(db_name, job_uuids)
 
     def process_notifications(self):
         for db in self.db_by_name.values():
-            while db.conn.notifies:
-                if self._stop:
-                    break
-                notification = db.conn.notifies.pop()
-                uuid = notification.payload
-                job_datas = db.select_jobs('uuid = %s', (uuid,))
-                if job_datas:
-                    self.channel_manager.notify(db.db_name, *job_datas[0])
+            if not db.conn.notifies:
+                continue
+            # drain all pending notifications, in the order they have
+            # been sent, so only the latest state of each job is applied
+            notifications = list(db.conn.notifies)
+            del db.conn.notifies[:]
+            if self._stop:
+                return
+            jobs_data = {}
+            id_ranges = []
+            for notification in notifications:
+                uuid, job_data = parse_payload(notification.payload)
+                if uuid is None:
+                    id_ranges.append(job_data)
                 else:
+                    jobs_data[uuid] = job_data
+            coalesced = len(notifications) - len(jobs_data)
+            self.coalesced_notifications += coalesced
+            _logger.debug("processing %d notifications for %d jobs "
+                          "(%d coalesced) on db %s", len(notifications),
+                          len(jobs_data), coalesced, db.db_name)
+            # jobs notified by an older trigger with only their uuid
+            uuids = set()
+            # jobs which are not running anymore
+            released = []
+            for uuid, job_data in jobs_data.items():
+                if job_data is False:
+                    uuids.add(uuid)
+                elif job_data is None:
                     self.channel_manager.remove_job(uuid)
+                    released.append(uuid)
+                else:
+                    self.channel_manager.notify(db.db_name, *job_data)
+                    if job_data[6] not in (ENQUEUED, STARTED):
+                        released.append(uuid)
+            if uuids:
+                for job_data in db.select_jobs_by_uuids(uuids):
+                    self.channel_manager.notify(db.db_name, *job_data)
+                    uuids.discard(job_data[1])
+                    if job_data[6] not in (ENQUEUED, STARTED):
+                        released.append(job_data[1])
+                # jobs that have not been found have been deleted
+                for uuid in uuids:
+                    self.channel_manager.remove_job(uuid)
+                    released.append(uuid)
+            # jobs inserted in bulk, read last as their state may have
+            # changed since their insertion
+            for min_id, max_id in id_ranges:
+                for job_data in db.select_jobs(
+                        'id BETWEEN %s AND %s AND state IN %s',
+                        (min_id, max_id, NOT_DONE)):
+                    self.channel_manager.notify(db.db_name, *job_data)
+            self.dispatcher.release(released)
+
+    def requeue_failed_dispatches(self):
+        """ Set back to pending the enqueued jobs Odoo could not run """
+        uuids_by_db = self._not_requeued
+        self._not_requeued = {}
+        for db_name, uuid in self.dispatcher.pop_failed():
+            uuids_by_db.setdefault(db_name, []).append(uuid)
+        for db_name, uuids in uuids_by_db.items():
+            db = self.db_by_name.get(db_name)
+            if db is None:
+                continue
+            try:
+                requeued = db.set_jobs_pending(uuids, (ENQUEUED,))
+            except Exception:
+                # do not interrupt the other databases
+                _logger.warning('error setting back to pending %d jobs not '
+                                'dispatched on db %s, retrying later',
+                                len(uuids), db_name, exc_info=True)
+                self._not_requeued[db_name] = uuids
+                continue
+            _logger.debug("%d jobs not dispatched set back to pending "
+                          "on db %s", len(requeued), db_name)
+
+    def reap_stale_jobs(self):
+        """ Set back to pending the jobs running for too long.
+
+        The threshold is the ``stale_timeout`` of the channel of the jobs.
+        Jobs are updated in bulk per database and threshold, and the
+        notifications of the updates put them back in the channel queues.
+        """
+        self._last_reap = time.time()
+        uuids_by_db_timeout = {}
+        for job in self.channel_manager.get_running_jobs():
+            timeout = job.channel.get_stale_timeout()
+            if timeout:
+                uuids_by_db_timeout.setdefault(
+                    (job.db_name, timeout), []).append(job.uuid)
+        for (db_name, timeout), uuids in uuids_by_db_timeout.items():
+            db = self.db_by_name.get(db_name)
+            if db is None:
+                continue
+            try:
+                reaped = db.set_jobs_pending(uuids, (ENQUEUED, STARTED),
+                                             older_than=timeout)
+            except Exception:
+                # the jobs are still running in the channels, they are
+                # reaped on the next pass
+                _logger.warning('error reaping stale jobs on db %s',
+                                db_name, exc_info=True)
+                continue
+            if reaped:
+                self.reaped += len(reaped)
+                _logger.warning("%d jobs enqueued or started for more than "
+                                "%s seconds set back to pending on db %s: %s",
+                                len(reaped), timeout, db_name,
+                                ', '.join(sorted(reaped)))
+
+    def get_select_timeout(self):
+        """ Seconds to wait for notifications before running jobs again.
+
+        This is the time until the next eta of the waiting jobs or until
+        rate limited channels accept jobs again, bounded by
+        ``SELECT_TIMEOUT``.
+        """
+        timeout = SELECT_TIMEOUT
+        now = openerp.fields.Datetime.now()
+        wakeup = self.channel_manager.get_wakeup_time(now)
+        if wakeup is not None:
+            from_string = openerp.fields.Datetime.from_string
+            delay = (from_string(wakeup) - from_string(now)).total_seconds()
+            # now has a precision of one second, do not loop
+            # until an eta within the current second is reached
+            timeout = min(max(delay, 1), timeout)
+        rate_limit_delay = self.channel_manager.get_rate_limit_delay()
+        if rate_limit_delay is not None:
+            timeout = min(rate_limit_delay, timeout)
+        if self.standby_db_names:
+            timeout = min(STANDBY_RETRY_INTERVAL, timeout)
+        return timeout
 
     def wait_notification(self):
         for db in self.db_by_name.values():
@@ -363,31 +1163,177 @@ class ConnectorRunner(object):
         # wait for something to happen in the queue_job tables
         conns = [db.conn for db in self.db_by_name.values()]
         conns.append(self._stop_pipe[0])
-        conns, _, _ = select.select(conns, [], [], SELECT_TIMEOUT)
+        conns, _, _ = select.select(conns, [], [], self.get_select_timeout())
         if conns and not self._stop:
             for conn in conns:
-                conn.poll()
+                if conn == self._stop_pipe[0]:
+                    # woken up by wakeup()
+                    os.read(conn, 4096)
+                else:
+                    conn.poll()
+
+    def wakeup(self):
+        """ Wake up the select() in wait_notification """
+        os.write(self._stop_pipe[1], '.')
+
+    def get_metrics(self):
+        """ Return the runner metrics in the Prometheus text format
+
+        >>> runner = ConnectorRunner(channel_config_string='root:4,A:2')
+        >>> runner.channel_manager.notify('db', 'A', 'A1', 1, 0, 10, None,
+        ...                               'pending')
+        >>> for line in runner.get_metrics().splitlines():
+        ...     if line.startswith('connector_channel_queued'):
+        ...         print(line)
+        connector_channel_queued{channel="root"} 0
+        connector_channel_queued{channel="root.A"} 1
+        """
+        lines = []
+
+        def metric(name, metric_type, help, values):
+            lines.append('# HELP connector_%s %s' % (name, help))
+            lines.append('# TYPE connector_%s %s' % (name, metric_type))
+            for labels, value in values:
+                labels = ','.join('%s="%s"' % (k, v) for k, v in labels)
+                lines.append('connector_%s%s %s' % (
+                    name, '{%s}' % labels if labels else '', value))
+
+        channels = self.channel_manager.get_channels()
+        metric('channel_queued', 'gauge', 'Jobs waiting in the channel.',
+               [((('channel', c.fullname),), c.queue_size)
+                for c in channels])
+        metric('channel_queue_heap_size', 'gauge',
+               'Entries in the channel queue heaps, including removed jobs.',
+               [((('channel', c.fullname),), c.queue_heap_size)
+                for c in channels])
+        metric('channel_running', 'gauge', 'Jobs running in the channel.',
+               [((('channel', c.fullname),), c.running_count)
+                for c in channels])
+        metric('channel_running_slots', 'gauge',
+               'Slots of the channel capacity used by running jobs.',
+               [((('channel', c.fullname),), c.running_slot_count)
+                for c in channels])
+        metric('channel_failed', 'gauge', 'Failed jobs in the channel.',
+               [((('channel', c.fullname),), c.failed_count)
+                for c in channels])
+        metric('channel_capacity', 'gauge', 'Capacity of the channel.',
+               [((('channel', c.fullname),), c.capacity)
+                for c in channels if c.capacity])
+        metric('channel_utilization', 'gauge',
+               'Ratio of the channel capacity in use.',
+               [((('channel', c.fullname),),
+                 float(c.running_slot_count) / c.capacity)
+                for c in channels if c.capacity])
+        metric('channel_transitions_total', 'counter',
+               'State transitions of the jobs in the channel.',
+               [((('channel', c.fullname), ('state', state)), count)
+                for c in channels
+                for state, count in sorted(c.transitions.items())])
+        metric('db_jobs', 'gauge', 'Jobs of the database known by the runner.',
+               [((('db', db_name),),
+                 self.channel_manager.count_db_jobs(db_name))
+                for db_name in sorted(self.channel_manager.get_db_names())])
+        metric('standby_dbs', 'gauge',
+               'Databases handled by the runner of another node.',
+               [((), len(self.standby_db_names))])
+        metric('dispatched_total', 'counter', 'Jobs sent to Odoo.',
+               [((), self.dispatched)])
+        metric('dispatch_errors_total', 'counter',
+               'Requests to run jobs which failed.',
+               [((), self.dispatcher.errors)])
+        now = time.time()
+        metric('endpoint_in_flight', 'gauge',
+               'Jobs sent to the endpoint which are not done.',
+               [((('endpoint', e.url),), len(e.in_flight))
+                for e in self.dispatcher.endpoints])
+        metric('endpoint_healthy', 'gauge',
+               'Whether the endpoint receives jobs.',
+               [((('endpoint', e.url),), int(e.is_healthy(now)))
+                for e in self.dispatcher.endpoints])
+        metric('dispatch_queue_depth', 'gauge',
+               'Jobs waiting for a free dispatch thread.',
+               [((), self.dispatcher.queue_depth)])
+        # a summary without quantiles only has _sum and _count samples
+        metric('dispatch_latency_seconds', 'summary',
+               'Delay between the pending notification and the dispatch '
+               'of the jobs without eta.', [])
+        lines.append('connector_dispatch_latency_seconds_sum %s' %
+                     self.dispatch_latency_sum)
+        lines.append('connector_dispatch_latency_seconds_count %s' %
+                     self.dispatch_latency_count)
+        metric('reaped_jobs_total', 'counter',
+               'Stale jobs set back to pending.',
+               [((), self.reaped)])
+        metric('notifications_coalesced_total', 'counter',
+               'Notifications processed without a query of their own.',
+               [((), self.coalesced_notifications)])
+        return '\n'.join(lines) + '\n'
+
+    def update_metrics(self):
+        """ Build the metrics served by the metrics server
+
+        The channels are modified by the runner thread, so the metrics are
+        not built by the thread of the metrics server.
+        """
+        if self._metrics_server:
+            self.metrics = self.get_metrics()
+
+    def start_metrics_server(self):
+        if not self.metrics_address:
+            return
+        try:
+            server = BaseHTTPServer.HTTPServer(self.metrics_address,
+                                               MetricsRequestHandler)
+        except Exception:
+            _logger.exception("could not start the metrics server on %s:%s",
+                              *self.metrics_address)
+            return
+        server.runner = self
+        self.metrics = self.get_metrics()
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='connector-metrics')
+        thread.daemon = True
+        thread.start()
+        self._metrics_server = server
+        _logger.info("serving metrics on http://%s:%s/metrics",
+                     *self.metrics_address)
+
+    def stop_metrics_server(self):
+        if self._metrics_server:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
 
     def stop(self):
         _logger.info("graceful stop requested")
         self._stop = True
-        # wakeup the select() in wait_notification
-        os.write(self._stop_pipe[1], '.')
+        self.wakeup()
 
     def run(self):
         _logger.info("starting")
+        self.dispatcher.start()
+        self.start_metrics_server()
         while not self._stop:
             # outer loop does exception recovery
             try:
                 _logger.info("initializing database connections")
-                # TODO: how to detect new databases or databases
-                #       on which connector is installed after server start?
                 self.initialize_databases()
                 _logger.info("database connections ready")
                 # inner loop does the normal processing
                 while not self._stop:
+                    if (time.time() - self._last_discovery >
+                            DB_DISCOVERY_INTERVAL):
+                        self.discover_databases()
+                    if (self.standby_db_names and
+                            time.time() - self._last_standby_retry >
+                            STANDBY_RETRY_INTERVAL):
+                        self.retry_standby_databases()
+                    self.requeue_failed_dispatches()
+                    if time.time() - self._last_reap > REAPER_INTERVAL:
+                        self.reap_stale_jobs()
                     self.process_notifications()
                     self.run_jobs()
+                    self.update_metrics()
                     self.wait_notification()
             except KeyboardInterrupt:
                 self.stop()
@@ -401,4 +1347,6 @@ class ConnectorRunner(object):
                     self.close_databases()
                     time.sleep(ERROR_RECOVERY_DELAY)
         self.close_databases(remove_jobs=False)
+        self.dispatcher.stop()
+        self.stop_metrics_server()
         _logger.info("stopped")
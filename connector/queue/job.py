@@ -19,8 +19,10 @@
 #
 ##############################################################################
 
+import hashlib
 import inspect
 import functools
+import json
 import logging
 import uuid
 import sys
@@ -28,6 +30,9 @@ from datetime import date, datetime, timedelta, MINYEAR
 from cPickle import dumps, UnpicklingError, Unpickler
 from cStringIO import StringIO
 
+import psycopg2
+from psycopg2 import errorcodes
+
 import openerp
 from openerp.tools.translate import _
 
@@ -51,6 +56,7 @@ STATES = [(PENDING, 'Pending'),
 DEFAULT_PRIORITY = 10  # used by the PriorityQueue to sort the jobs
 DEFAULT_MAX_RETRIES = 5
 RETRY_INTERVAL = 10 * 60  # seconds
+BATCH_INSERT_SIZE = 1000  # jobs inserted by one statement in store_batch
 
 _logger = logging.getLogger(__name__)
 
@@ -115,6 +121,150 @@ def _unpickle(pickled):
     return unpickled
 
 
+# version of the JSON format of the stored functions
+SERIALIZATION_VERSION = 1
+
+
+class _NotSerializable(Exception):
+    """ The value cannot be serialized in JSON, pickle is used instead """
+
+
+def _is_ascii(value):
+    try:
+        if isinstance(value, unicode):
+            value.encode('ascii')
+        else:
+            value.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def _to_json(value):
+    """ Convert a job argument to a value accepted by ``json.dumps``
+
+    The strings are read back as bytestrings when they are ASCII and as
+    unicode otherwise, so the bytestrings commonly used for the names of
+    the models and fields are stored without overhead. ASCII unicode
+    strings, tuples, dates, datetimes and timedeltas are converted to
+    dicts with a single tag key. The keys of the dicts follow the same
+    rule as the strings but cannot be tagged: ASCII unicode keys are read
+    back as bytestrings, which are equal.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    elif isinstance(value, unicode):
+        if _is_ascii(value):
+            return {'$u': value}
+        return value
+    elif isinstance(value, str):
+        if not _is_ascii(value):
+            raise _NotSerializable(value)
+        return value
+    elif isinstance(value, list):
+        return [_to_json(item) for item in value]
+    elif isinstance(value, tuple):
+        return {'$t': [_to_json(item) for item in value]}
+    elif isinstance(value, dict):
+        if len(value) == 1 and next(iter(value)) in _JSON_TAGS:
+            raise _NotSerializable(value)
+        result = {}
+        for key, item in value.iteritems():
+            if not isinstance(key, basestring) or (
+                    isinstance(key, str) and not _is_ascii(key)):
+                raise _NotSerializable(value)
+            result[key] = _to_json(item)
+        return result
+    elif isinstance(value, datetime):
+        if value.tzinfo:
+            raise _NotSerializable(value)
+        return {'$dt': value.isoformat()}
+    elif isinstance(value, date):
+        return {'$d': value.isoformat()}
+    elif isinstance(value, timedelta):
+        return {'$td': [value.days, value.seconds, value.microseconds]}
+    raise _NotSerializable(value)
+
+
+def _parse_datetime(value):
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+_JSON_TAGS = {
+    '$u': lambda value: value,
+    '$t': lambda value: tuple(_from_json(value)),
+    '$dt': _parse_datetime,
+    '$d': lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+    '$td': lambda value: timedelta(*value),
+}
+
+
+def _from_json(value):
+    """ Convert back a value converted by :func:`_to_json` and read by
+    ``json.loads`` """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    elif isinstance(value, list):
+        # skip the call for the numbers, which are the bulk of big lists
+        return [_from_json(item)
+                if isinstance(item, (unicode, list, dict)) else item
+                for item in value]
+    elif isinstance(value, dict):
+        if len(value) == 1:
+            tag, item = value.items()[0]
+            if tag in _JSON_TAGS:
+                return _JSON_TAGS[tag](item)
+        return dict((_from_json(key), _from_json(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def _serialize_func(func_name, args, kwargs):
+    """ Serialize the function of a job and its arguments
+
+    A compact JSON document with a version marker is used when the
+    arguments are only builtin types, tuples, dates, datetimes and
+    timedeltas, otherwise they are pickled.
+    """
+    try:
+        func = {'v': SERIALIZATION_VERSION,
+                'f': func_name,
+                'a': [_to_json(arg) for arg in args]}
+        if kwargs:
+            func['k'] = _to_json(kwargs)
+        return json.dumps(func, separators=(',', ':'))
+    except _NotSerializable:
+        return dumps((func_name, args, kwargs))
+
+
+def _deserialize_func(serialized):
+    """ Read the function of a job and its arguments stored by
+    :func:`_serialize_func`, return ``(func_name, args, kwargs)``.
+
+    Only the types listed in :func:`_to_json` can be read from JSON, the
+    pickled functions are read by :func:`_unpickle`, with its whitelist.
+    """
+    if not serialized.startswith('{'):
+        return _unpickle(serialized)
+    try:
+        func = json.loads(serialized)
+        if func['v'] != SERIALIZATION_VERSION:
+            raise ValueError('Unknown version %s' % func['v'])
+        # keyword arguments must be bytestrings
+        kwargs = dict((key.encode('ascii'), _from_json(value))
+                      for key, value in func.get('k', {}).iteritems())
+        return (func['f'].encode('ascii'), tuple(_from_json(func['a'])),
+                kwargs)
+    except StandardError:
+        raise NotReadableJobError('Could not read the job function.',
+                                  serialized)
+
+
 class JobStorage(object):
     """ Interface for the storage of jobs """
 
@@ -146,16 +296,22 @@ class OpenERPJobStorage(JobStorage):
             "Model %s not found" % self._job_model_name)
 
     def enqueue(self, func, model_name=None, args=None, kwargs=None,
-                priority=None, eta=None, max_retries=None, description=None):
+                priority=None, eta=None, max_retries=None, description=None,
+                identity_key=None):
         """Create a Job and enqueue it in the queue. Return the job uuid.
 
         This expects the arguments specific to the job to be already extracted
         from the ones to pass to the job function.
 
+        When a pending job has the same identity key, no job is created
+        and the uuid of the pending job is returned. None is returned when
+        the pending job is created by a concurrent transaction which is not
+        visible yet.
         """
         new_job = Job(func=func, model_name=model_name, args=args,
                       kwargs=kwargs, priority=priority, eta=eta,
-                      max_retries=max_retries, description=description)
+                      max_retries=max_retries, description=description,
+                      identity_key=identity_key)
         new_job.user_id = self.session.uid
         if 'company_id' in self.session.context:
             company_id = self.session.context['company_id']
@@ -166,7 +322,8 @@ class OpenERPJobStorage(JobStorage):
                 object='queue.job',
                 field='company_id')
         new_job.company_id = company_id
-        self.store(new_job)
+        if self.store(new_job) is False:
+            return None
         return new_job.uuid
 
     def enqueue_resolve_args(self, func, *args, **kwargs):
@@ -176,13 +333,63 @@ class OpenERPJobStorage(JobStorage):
         model_name = kwargs.pop('model_name', None)
         max_retries = kwargs.pop('max_retries', None)
         description = kwargs.pop('description', None)
+        identity_key = kwargs.pop('identity_key', None)
 
         return self.enqueue(func, model_name=model_name,
                             args=args, kwargs=kwargs,
                             priority=priority,
                             max_retries=max_retries,
                             eta=eta,
-                            description=description)
+                            description=description,
+                            identity_key=identity_key)
+
+    def enqueue_batch(self, func, args_list, model_name=None, kwargs=None,
+                      priority=None, eta=None, max_retries=None,
+                      description=None, identity_key=None):
+        """Create a Job for each arguments of ``args_list`` and enqueue
+        them at once. Return the list of the job uuids.
+
+        The other arguments are shared by all the jobs. Jobs with the same
+        identity key as a pending job, or as a previous job of the list,
+        are not created, the uuid of the existing job is returned instead.
+        The jobs identical to a job created by a concurrent transaction
+        which is not visible yet are left out of the list.
+        """
+        if 'company_id' in self.session.context:
+            company_id = self.session.context['company_id']
+        else:
+            company_model = self.session.env['res.company']
+            company_model = company_model.sudo(self.session.uid)
+            company_id = company_model._company_default_get(
+                object='queue.job',
+                field='company_id')
+        jobs = []
+        for args in args_list:
+            new_job = Job(func=func, model_name=model_name, args=args,
+                          kwargs=kwargs, priority=priority, eta=eta,
+                          max_retries=max_retries, description=description,
+                          identity_key=identity_key)
+            new_job.user_id = self.session.uid
+            new_job.company_id = company_id
+            jobs.append(new_job)
+        return self.store_batch(jobs)
+
+    def enqueue_batch_resolve_args(self, func, args_list, **kwargs):
+        """Create Jobs and enqueue them at once. Return the job uuids."""
+        priority = kwargs.pop('priority', None)
+        eta = kwargs.pop('eta', None)
+        model_name = kwargs.pop('model_name', None)
+        max_retries = kwargs.pop('max_retries', None)
+        description = kwargs.pop('description', None)
+        identity_key = kwargs.pop('identity_key', None)
+
+        return self.enqueue_batch(func, args_list, model_name=model_name,
+                                  kwargs=kwargs,
+                                  priority=priority,
+                                  max_retries=max_retries,
+                                  eta=eta,
+                                  description=description,
+                                  identity_key=identity_key)
 
     def exists(self, job_uuid):
         """Returns if a job still exists in the storage."""
@@ -205,7 +412,11 @@ class OpenERPJobStorage(JobStorage):
             return worker.id
 
     def store(self, job_):
-        """ Store the Job """
+        """ Store the Job
+
+        Return False when the job is not created because an identical job
+        is pending in a concurrent transaction which is not visible yet.
+        """
         vals = {'state': job_.state,
                 'priority': job_.priority,
                 'retry': job_.retry,
@@ -234,12 +445,34 @@ class OpenERPJobStorage(JobStorage):
         if job_.canceled:
             vals['active'] = False
 
+        if job_.state == FAILED:
+            # go through the ORM which posts a message on failed jobs
+            db_record = self.db_record(job_)
+        elif job_.state == PENDING and job_.identity_key:
+            try:
+                with self.session.cr.savepoint():
+                    updated = self._update(job_, vals)
+            except psycopg2.IntegrityError as err:
+                if err.pgcode != errorcodes.UNIQUE_VIOLATION:
+                    raise
+                # a job with the same identity key is already pending,
+                # for instance when the job is retried
+                job_.cancel(_('Superseded by an identical pending job.'))
+                self.store(job_)
+                return
+            if updated:
+                return
+            db_record = None
+        elif self._update(job_, vals):
+            return
+        else:
+            db_record = None
+
         if job_.worker_uuid:
             vals['worker_id'] = self._worker_id(job_.worker_uuid)
         else:
             vals['worker_id'] = False
 
-        db_record = self.db_record(job_)
         if db_record:
             db_record.write(vals)
         else:
@@ -252,56 +485,290 @@ class OpenERPJobStorage(JobStorage):
                                         else False),
                          })
 
-            vals['func'] = dumps((job_.func_name,
-                                  job_.args,
-                                  job_.kwargs))
+            vals['func'] = _serialize_func(job_.func_name,
+                                           job_.args,
+                                           job_.kwargs)
 
-            self.job_model.sudo().create(vals)
+            if not job_.identity_key:
+                self.job_model.sudo().create(vals)
+                return
+            vals['identity_key'] = job_.identity_key
+            try:
+                with self.session.cr.savepoint():
+                    self.job_model.sudo().create(vals)
+            except psycopg2.IntegrityError as err:
+                if err.pgcode != errorcodes.UNIQUE_VIOLATION:
+                    raise
+                self.session.env.invalidate_all()
+                pending = self._pending_job_uuids([job_.identity_key])
+                if job_.identity_key not in pending:
+                    # committed after the start of our transaction
+                    _logger.debug('job %s not created, a job with the same '
+                                  'identity key is pending', job_.uuid)
+                    return False
+                _logger.debug('job %s not created, %s is pending with the '
+                              'same identity key', job_.uuid,
+                              pending[job_.identity_key])
+                # the job is the pending one
+                job_._uuid = pending[job_.identity_key]
+
+    def _pending_job_uuids(self, identity_keys):
+        """ Return the uuids of the pending jobs by identity key """
+        cr = self.session.cr
+        cr.execute("SELECT identity_key, uuid FROM queue_job "
+                   "WHERE identity_key IN %s AND state = %s",
+                   (tuple(identity_keys), PENDING))
+        return dict(cr.fetchall())
+
+    def _update(self, job_, vals):
+        """ Update the row of an existing job with a single statement
+
+        The ORM is bypassed, the cache of the job model is invalidated.
+        Return False when the job does not exist yet.
+        """
+        columns = sorted(vals)
+        query = ("UPDATE queue_job SET %s, "
+                 "worker_id = (SELECT id FROM queue_worker WHERE uuid = %%s) "
+                 "WHERE uuid = %%s RETURNING id" %
+                 ', '.join('%s = %%s' % column for column in columns))
+        params = [vals[column] if vals[column] is not False else None
+                  for column in columns]
+        params += [job_.worker_uuid, job_.uuid]
+        cr = self.session.cr
+        cr.execute(query, params)
+        row = cr.fetchone()
+        if not row:
+            return False
+        self.job_model.invalidate_cache(ids=[row[0]])
+        return True
+
+    def store_batch(self, jobs):
+        """ Insert new jobs with multi-row INSERT statements
+
+        The ORM is bypassed, so the channel and the job function computed
+        by ``queue.job`` are computed here. Instead of a notification per
+        job, the job runner receives a single notification with the range
+        of the inserted ids.
+
+        Jobs with the same identity key as a pending job are not inserted,
+        they take the uuid of the pending job. When an identical job is
+        created by a concurrent transaction in the meantime, the rows of the
+        statement are inserted one by one and the duplicates are skipped.
+
+        Return the uuids of the jobs, the jobs which are skipped without a
+        visible pending job are left out.
+        """
+        all_jobs = jobs
+        # jobs having the identity key of a previous job of the list
+        duplicates = []
+        identity_keys = set(job_.identity_key for job_ in jobs
+                            if job_.identity_key)
+        if identity_keys:
+            pending = self._pending_job_uuids(identity_keys)
+            first_jobs = {}
+            new_jobs = []
+            for job_ in jobs:
+                if job_.identity_key in pending:
+                    job_._uuid = pending[job_.identity_key]
+                    continue
+                if job_.identity_key in first_jobs:
+                    duplicates.append((job_, first_jobs[job_.identity_key]))
+                    continue
+                if job_.identity_key:
+                    first_jobs[job_.identity_key] = job_
+                new_jobs.append(job_)
+            jobs = new_jobs
+        if not jobs:
+            return [job_.uuid for job_ in all_jobs]
+        cr = self.session.cr
+        function_model = self.session.env['queue.job.function'].sudo()
+        functions = {}
+        dt_to_string = openerp.fields.Datetime.to_string
+        columns = ('uuid', 'name', 'func_string', 'func_name', 'func',
+                   'model_name', 'state', 'priority', 'retry',
+                   'max_retries', 'user_id', 'company_id', 'date_created',
+                   'eta', 'active', 'job_function_id', 'channel',
+                   'identity_key')
+        rows = []
+        for job_ in jobs:
+            if job_.func_name not in functions:
+                function = function_model.search(
+                    [('name', '=', job_.func_name)], limit=1)
+                functions[job_.func_name] = (function.id or None,
+                                             function.channel or None)
+            function_id, channel = functions[job_.func_name]
+            func = _serialize_func(job_.func_name, job_.args, job_.kwargs)
+            rows.append((job_.uuid,
+                         job_.description,
+                         job_.func_string,
+                         job_.func_name,
+                         psycopg2.Binary(func),
+                         job_.model_name or None,
+                         job_.state,
+                         job_.priority,
+                         job_.retry,
+                         job_.max_retries,
+                         job_.user_id or self.session.uid,
+                         job_.company_id or None,
+                         dt_to_string(job_.date_created),
+                         dt_to_string(job_.eta) if job_.eta else None,
+                         not job_.canceled,
+                         function_id,
+                         channel,
+                         job_.identity_key or None,
+                         ))
+        row_placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        query = ("INSERT INTO queue_job (%s) VALUES %%s RETURNING id" %
+                 ', '.join(columns))
+        ids = []
+        skipped = set()
+        # the setting is local to the transaction, it is reset just after
+        # the inserts so the next changes of the jobs are notified
+        cr.execute("SELECT set_config('connector.suppress_notify', 'on', "
+                   "true)")
+        for i in range(0, len(rows), BATCH_INSERT_SIZE):
+            chunk = rows[i:i + BATCH_INSERT_SIZE]
+            values = ', '.join(cr.mogrify(row_placeholders, row)
+                               for row in chunk)
+            try:
+                with cr.savepoint():
+                    cr.execute(query % values)
+            except psycopg2.IntegrityError as err:
+                if err.pgcode != errorcodes.UNIQUE_VIOLATION:
+                    raise
+                ids.extend(self._insert_rows(query, row_placeholders,
+                                             jobs[i:i + BATCH_INSERT_SIZE],
+                                             chunk, skipped))
+            else:
+                ids.extend(row[0] for row in cr.fetchall())
+        cr.execute("SELECT set_config('connector.suppress_notify', 'off', "
+                   "true)")
+        if ids:
+            payload = json.dumps({'id_range': [min(ids), max(ids)]})
+            cr.execute("SELECT pg_notify('connector', %s)", (payload,))
+        for job_, first_job in duplicates:
+            job_._uuid = first_job.uuid
+        return [job_.uuid for job_ in all_jobs if job_.uuid not in skipped]
+
+    def _insert_rows(self, query, row_placeholders, jobs, rows, skipped):
+        """ Insert the rows of ``jobs`` one by one, skip the jobs having the
+        identity key of a job pending in another transaction
+
+        Return the ids of the inserted rows. The uuids of the skipped jobs
+        which have no visible pending job are added to ``skipped``.
+        """
+        cr = self.session.cr
+        ids = []
+        for job_, row in zip(jobs, rows):
+            try:
+                with cr.savepoint():
+                    cr.execute(query % cr.mogrify(row_placeholders, row))
+            except psycopg2.IntegrityError as err:
+                if (err.pgcode != errorcodes.UNIQUE_VIOLATION or
+                        not job_.identity_key):
+                    raise
+                pending = self._pending_job_uuids([job_.identity_key])
+                _logger.debug('job %s not created, a job with the same '
+                              'identity key is pending', job_.uuid)
+                if job_.identity_key in pending:
+                    job_._uuid = pending[job_.identity_key]
+                else:
+                    # committed after the start of our transaction
+                    skipped.add(job_.uuid)
+            else:
+                ids.append(cr.fetchone()[0])
+        return ids
+
+    # columns read by load(), in the order expected by _job_from_row()
+    _load_columns = ('uuid', 'func', 'name', 'priority', 'eta',
+                     'date_created', 'date_enqueued', 'date_started',
+                     'date_done', 'state', 'result', 'exc_info', 'user_id',
+                     'active', 'model_name', 'retry', 'max_retries',
+                     'company_id', 'identity_key')
+
+    def _load_query(self, where, table='queue_job'):
+        """ Return the query reading the jobs in a single statement """
+        return ("SELECT %s, queue_worker.uuid FROM %s AS job "
+                "LEFT JOIN queue_worker "
+                "ON queue_worker.id = job.worker_id "
+                "WHERE %s" %
+                (', '.join('job.%s' % column
+                           for column in self._load_columns),
+                 table, where))
 
     def load(self, job_uuid):
         """ Read a job from the Database"""
-        stored = self.db_record_from_uuid(job_uuid)
-        if not stored:
+        cr = self.session.cr
+        cr.execute(self._load_query('job.uuid = %s'), (job_uuid,))
+        row = cr.fetchone()
+        if not row:
             raise NoSuchJobError(
                 'Job %s does no longer exist in the storage.' % job_uuid)
+        return self._job_from_row(row)
+
+    def claim(self, job_uuid):
+        """ Set an enqueued job as started and read it, in one statement
+
+        Return the started job, or None when the job does not exist or is
+        not enqueued, for instance because it is already started by
+        another request.
+        """
+        cr = self.session.cr
+        cr.execute("WITH claimed AS ("
+                   "    UPDATE queue_job SET state = %s, date_started = %s "
+                   "    WHERE uuid = %s AND state = %s "
+                   "    RETURNING *"
+                   ") " + self._load_query('true', table='claimed'),
+                   (STARTED, openerp.fields.Datetime.now(), job_uuid,
+                    ENQUEUED))
+        row = cr.fetchone()
+        if not row:
+            return None
+        self.job_model.invalidate_cache(['state', 'date_started'])
+        return self._job_from_row(row)
+
+    def _job_from_row(self, row):
+        """ Build a Job from a row read by the query of ``_load_query`` """
+        stored = dict(zip(self._load_columns + ('worker_uuid',), row))
 
-        func = _unpickle(stored.func)
+        func = _deserialize_func(str(stored['func']))
 
         (func_name, args, kwargs) = func
 
         dt_from_string = openerp.fields.Datetime.from_string
         eta = None
-        if stored.eta:
-            eta = dt_from_string(stored.eta)
+        if stored['eta']:
+            eta = dt_from_string(stored['eta'])
 
         job_ = Job(func=func_name, args=args, kwargs=kwargs,
-                   priority=stored.priority, eta=eta, job_uuid=stored.uuid,
-                   description=stored.name)
-
-        if stored.date_created:
-            job_.date_created = dt_from_string(stored.date_created)
-
-        if stored.date_enqueued:
-            job_.date_enqueued = dt_from_string(stored.date_enqueued)
-
-        if stored.date_started:
-            job_.date_started = dt_from_string(stored.date_started)
-
-        if stored.date_done:
-            job_.date_done = dt_from_string(stored.date_done)
-
-        job_.state = stored.state
-        job_.result = stored.result if stored.result else None
-        job_.exc_info = stored.exc_info if stored.exc_info else None
-        job_.user_id = stored.user_id.id if stored.user_id else None
-        job_.canceled = not stored.active
-        job_.model_name = stored.model_name if stored.model_name else None
-        job_.retry = stored.retry
-        job_.max_retries = stored.max_retries
-        if stored.worker_id:
-            job_.worker_uuid = stored.worker_id.uuid
-        if stored.company_id:
-            job_.company_id = stored.company_id.id
+                   priority=stored['priority'] or 0, eta=eta,
+                   job_uuid=stored['uuid'], description=stored['name'])
+
+        if stored['date_created']:
+            job_.date_created = dt_from_string(stored['date_created'])
+
+        if stored['date_enqueued']:
+            job_.date_enqueued = dt_from_string(stored['date_enqueued'])
+
+        if stored['date_started']:
+            job_.date_started = dt_from_string(stored['date_started'])
+
+        if stored['date_done']:
+            job_.date_done = dt_from_string(stored['date_done'])
+
+        job_.state = stored['state']
+        job_.result = stored['result'] or None
+        job_.exc_info = stored['exc_info'] or None
+        job_.user_id = stored['user_id'] or None
+        job_.canceled = not stored['active']
+        job_.model_name = stored['model_name'] or None
+        job_.retry = stored['retry'] or 0
+        job_.max_retries = stored['max_retries'] or 0
+        if stored['worker_uuid']:
+            job_.worker_uuid = stored['worker_uuid']
+        if stored['company_id']:
+            job_.company_id = stored['company_id']
+        job_.identity_key = stored['identity_key'] or None
         return job_
 
 
@@ -401,12 +868,17 @@ class Job(object):
 
         True if the job has been canceled.
 
+    .. attribute:: identity_key
+
+        Key identifying identical jobs: a job is not created when a pending
+        job has the same key.
+
     """
 
     def __init__(self, func=None, model_name=None,
                  args=None, kwargs=None, priority=None,
                  eta=None, job_uuid=None, max_retries=None,
-                 description=None):
+                 description=None, identity_key=None):
         """ Create a Job
 
         :param func: function to execute
@@ -428,6 +900,10 @@ class Job(object):
             the job state to 'failed'. A value of 0 means infinite retries.
         :param description: human description of the job. If None, description
             is computed from the function doc or name
+        :param identity_key: key identifying identical jobs, only one of
+            them can be pending. A string, or a function called with the
+            job which returns the key (see :func:`identity_exact`). If
+            None, the ``identity_key`` of the job function is used.
         """
         if args is None:
             args = ()
@@ -487,6 +963,12 @@ class Job(object):
         self.canceled = False
         self.worker_uuid = None
 
+        if identity_key is None and inspect.isfunction(func):
+            identity_key = getattr(func, 'identity_key', None)
+        if callable(identity_key):
+            identity_key = identity_key(self)
+        self.identity_key = identity_key
+
     def __cmp__(self, other):
         if not isinstance(other, Job):
             raise TypeError("Job.__cmp__(self, other) requires other to be "
@@ -653,7 +1135,26 @@ class Job(object):
 JOB_REGISTRY = set()
 
 
-def job(func=None, default_channel='root', retry_pattern=None):
+def identity_exact(job_):
+    """ Identity key using the function, the model and the arguments
+
+    To use as ``identity_key`` so a job is not created when a pending job
+    has the same function and arguments::
+
+        @job(identity_key=identity_exact)
+        def export_record(session, model_name, binding_id, fields=None):
+            # ...
+
+    """
+    hasher = hashlib.sha1()
+    hasher.update(job_.func_name)
+    hasher.update(repr(job_.args))
+    hasher.update(repr(sorted(job_.kwargs.iteritems())))
+    return hasher.hexdigest()
+
+
+def job(func=None, default_channel='root', retry_pattern=None,
+        identity_key=None):
     """ Decorator for jobs.
 
     Optional argument:
@@ -668,8 +1169,13 @@ def job(func=None, default_channel='root', retry_pattern=None):
                           is provided, jobs will be retried after
                           :const:`RETRY_INTERVAL` seconds.
     :type retry_pattern: dict(retry_count,retry_eta_seconds)
+    :param identity_key: default identity key of the jobs, a function
+                         called with the job and returning the key, for
+                         instance :func:`identity_exact`. When a job
+                         has the same identity key as a pending job, it
+                         is not created.
 
-    Add a ``delay`` attribute on the decorated function.
+    Add ``delay`` and ``delay_many`` attributes on the decorated function.
 
     When ``delay`` is called, the function is transformed to a job and
     stored in the OpenERP queue.job model. The arguments and keyword
@@ -691,7 +1197,7 @@ def job(func=None, default_channel='root', retry_pattern=None):
      Arguments and keyword arguments which will be given to the called
      function once the job is executed. They should be ``pickle-able``.
 
-     There are 5 special and reserved keyword arguments that you can use:
+     There are 6 special and reserved keyword arguments that you can use:
 
      * priority: priority of the job, the smaller is the higher priority.
                  Default is 10.
@@ -704,6 +1210,10 @@ def job(func=None, default_channel='root', retry_pattern=None):
                      intended to discriminate job instances
                      (Default is the func.__doc__ or
                       'Function %s' % func.__name__)
+     * identity_key: key identifying identical jobs (a string or a function
+                     called with the job), the job is not created when a
+                     pending job has the same key. Default is the
+                     ``identity_key`` of the decorator.
 
     Example:
 
@@ -725,6 +1235,12 @@ def job(func=None, default_channel='root', retry_pattern=None):
         # => the job will be executed with a low priority and not before a
         # delay of 5 hours from now
 
+        export_one_thing.delay_many(session, 'a.model',
+                                    [(thing,) for thing in things_to_export],
+                                    priority=30)
+        # => one job per thing, all inserted at once, much faster than
+        # calling ``delay`` for each of them
+
         @job(default_channel='root.subchannel')
         def export_one_thing(session, model_name, one_thing):
             # work
@@ -750,16 +1266,31 @@ def job(func=None, default_channel='root', retry_pattern=None):
     """
     if func is None:
         return functools.partial(job, default_channel=default_channel,
-                                 retry_pattern=retry_pattern)
+                                 retry_pattern=retry_pattern,
+                                 identity_key=identity_key)
 
     def delay(session, model_name, *args, **kwargs):
-        """Enqueue the function. Return the uuid of the created job."""
+        """Enqueue the function. Return the uuid of the created job.
+
+        None is returned when an identical job created by a concurrent
+        transaction is pending."""
         return OpenERPJobStorage(session).enqueue_resolve_args(
             func,
             model_name=model_name,
             *args,
             **kwargs)
 
+    def delay_many(session, model_name, args_list, **kwargs):
+        """Enqueue the function once for each tuple of arguments of
+        ``args_list``. Return the uuids of the created jobs, the jobs
+        identical to a job pending in a concurrent transaction are left
+        out."""
+        return OpenERPJobStorage(session).enqueue_batch_resolve_args(
+            func,
+            args_list,
+            model_name=model_name,
+            **kwargs)
+
     assert default_channel == 'root' or default_channel.startswith('root.'), (
         "The channel path must start by 'root'")
     func.default_channel = default_channel
@@ -767,7 +1298,9 @@ def job(func=None, default_channel='root', retry_pattern=None):
         "retry_pattern must be a dict"
     )
     func.retry_pattern = retry_pattern
+    func.identity_key = identity_key
     func.delay = delay
+    func.delay_many = delay_many
     JOB_REGISTRY.add(func)
     return func
 
@@ -21,6 +21,7 @@
 
 import os
 import logging
+import time
 from datetime import datetime, timedelta
 
 from openerp import models, fields, api, exceptions, _
@@ -34,6 +35,22 @@ from ..connector import get_openerp_module, is_module_installed
 _logger = logging.getLogger(__name__)
 
 
+def _create_index(cr, name, table, columns, where=None, unique=False):
+    """ Create an index unless an index with the same name exists
+
+    ``where`` makes it a partial index.
+    """
+    cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", (name,))
+    if cr.fetchone():
+        return
+    query = "CREATE %sINDEX %s ON %s (%s)" % ('UNIQUE ' if unique else '',
+                                              name, table, columns)
+    if where:
+        query += " WHERE %s" % where
+    _logger.info('creating index %s on %s', name, table)
+    cr.execute(query)
+
+
 class QueueJob(models.Model):
     """ Job status and result """
     _name = 'queue.job'
@@ -44,6 +61,10 @@ class QueueJob(models.Model):
     _order = 'date_created DESC, date_done DESC'
 
     _removal_interval = 30  # days
+    # move the jobs to the queue_job_archive table instead of deleting them
+    _archive = False
+    _removal_chunk_size = 1000  # jobs removed by transaction
+    _removal_time_budget = 10 * 60  # seconds by autovacuum
 
     worker_id = fields.Many2one(comodel_name='queue.worker',
                                 string='Worker',
@@ -94,6 +115,24 @@ class QueueJob(models.Model):
                                       store=True)
     # for searching without JOIN on channels
     channel = fields.Char(compute='_compute_channel', store=True, select=True)
+    identity_key = fields.Char(readonly=True)
+
+    def init(self, cr):
+        # only one pending job by identity key
+        _create_index(cr, 'queue_job_identity_key_state_pending_index',
+                      'queue_job', 'identity_key',
+                      where="state = 'pending' AND identity_key IS NOT NULL",
+                      unique=True)
+        # the job runner only reads the jobs which are not done, this
+        # index stays small when the table is full of done jobs
+        not_done = tuple(state for state, __ in STATES if state != DONE)
+        _create_index(cr, 'queue_job_state_not_done_index',
+                      'queue_job', 'state',
+                      where=cr.mogrify("state IN %s", (not_done,)))
+        # for the autovacuum
+        _create_index(cr, 'queue_job_date_done_index',
+                      'queue_job', 'date_done',
+                      where="date_done IS NOT NULL")
 
     @api.one
     @api.depends('func_name', 'job_function_id.channel_id')
@@ -121,13 +160,16 @@ class QueueJob(models.Model):
     def _change_job_state(self, state, result=None):
         """ Change the state of the `Job` object itself so it
         will change the other fields (date, result, ...)
+
+        A job set to pending while an identical job (same identity key) is
+        pending is canceled instead.
         """
         session = ConnectorSession(self.env.cr,
                                    self.env.uid,
                                    context=self.env.context)
         storage = OpenERPJobStorage(session)
-        for job in self:
-            job = storage.load(job.uuid)
+        for record in self:
+            job = storage.load(record.uuid)
             if state == DONE:
                 job.set_done(result=result)
             elif state == PENDING:
@@ -135,6 +177,10 @@ class QueueJob(models.Model):
             else:
                 raise ValueError('State not supported: %s' % state)
             storage.store(job)
+            if state == PENDING and job.state == DONE:
+                record.message_post(
+                    body=_('The job has not been requeued because an '
+                           'identical job is already pending.'))
 
     @api.multi
     def button_done(self):
@@ -204,15 +250,112 @@ class QueueJob(models.Model):
         """ Delete all jobs (active or not) done since more than
         ``_removal_interval`` days.
 
+        When ``_archive`` is True, the jobs are moved to the
+        ``queue_job_archive`` table instead.
+
+        The jobs are removed with SQL statements by chunks of
+        ``_removal_chunk_size``, each chunk is committed. The remaining
+        jobs are left to the next run after ``_removal_time_budget``
+        seconds.
+
         Called from a cron.
         """
         deadline = datetime.now() - timedelta(days=self._removal_interval)
-        jobs = self.with_context(active_test=False).search(
-            [('date_done', '<=', fields.Datetime.to_string(deadline))],
-        )
-        jobs.unlink()
+        deadline = fields.Datetime.to_string(deadline)
+        if self._archive:
+            columns = self._create_archive_table()
+        cr = self.env.cr
+        start = time.time()
+        count = 0
+        while True:
+            if self._archive:
+                job_ids = self._archive_chunk(deadline, columns)
+            else:
+                job_ids = self._delete_chunk(deadline)
+            self._delete_messages(job_ids)
+            cr.commit()
+            count += len(job_ids)
+            if len(job_ids) < self._removal_chunk_size:
+                break
+            if time.time() - start > self._removal_time_budget:
+                _logger.info('autovacuum time budget exhausted, the '
+                             'remaining jobs are removed by the next run')
+                break
+        self.invalidate_cache()
+        elapsed = time.time() - start
+        _logger.info('autovacuum: %d jobs %s in %.1fs (%d jobs/s)',
+                     count, 'archived' if self._archive else 'deleted',
+                     elapsed, count / max(elapsed, 1e-6))
         return True
 
+    @api.model
+    def _delete_chunk(self, deadline):
+        """ Delete up to ``_removal_chunk_size`` jobs done before
+        ``deadline`` and return their ids """
+        cr = self.env.cr
+        cr.execute("DELETE FROM queue_job WHERE id IN ("
+                   "    SELECT id FROM queue_job WHERE date_done <= %s "
+                   "    LIMIT %s"
+                   ") RETURNING id",
+                   (deadline, self._removal_chunk_size))
+        return [job_id for job_id, in cr.fetchall()]
+
+    @api.model
+    def _create_archive_table(self):
+        """ Create the ``queue_job_archive`` table if it does not exist
+
+        Return the columns shared with ``queue_job``: columns added to
+        ``queue_job`` after the creation of the archive are not archived.
+        """
+        cr = self.env.cr
+        cr.execute("CREATE TABLE IF NOT EXISTS queue_job_archive "
+                   "(LIKE queue_job)")
+        _create_index(cr, 'queue_job_archive_uuid_index',
+                      'queue_job_archive', 'uuid')
+        _create_index(cr, 'queue_job_archive_date_done_index',
+                      'queue_job_archive', 'date_done')
+        cr.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_name = 'queue_job' AND column_name IN ("
+                   "    SELECT column_name FROM information_schema.columns "
+                   "    WHERE table_name = 'queue_job_archive') "
+                   "ORDER BY ordinal_position")
+        return [column for column, in cr.fetchall()]
+
+    @api.model
+    def _archive_chunk(self, deadline, columns):
+        """ Move up to ``_removal_chunk_size`` jobs done before ``deadline``
+        to ``queue_job_archive`` and return their ids
+
+        ``columns`` are the columns to copy, as returned by
+        :meth:`_create_archive_table`.
+        """
+        columns = ', '.join('"%s"' % column for column in columns)
+        query = ("WITH moved AS ("
+                 "    DELETE FROM queue_job WHERE id IN ("
+                 "        SELECT id FROM queue_job WHERE date_done <= %%s "
+                 "        LIMIT %%s"
+                 "    ) RETURNING %(columns)s"
+                 ") "
+                 "INSERT INTO queue_job_archive (%(columns)s) "
+                 "SELECT %(columns)s FROM moved RETURNING id" %
+                 {'columns': columns})
+        cr = self.env.cr
+        cr.execute(query, (deadline, self._removal_chunk_size))
+        return [job_id for job_id, in cr.fetchall()]
+
+    @api.model
+    def _delete_messages(self, job_ids):
+        """ Delete the messages and followers of jobs deleted in SQL """
+        if not job_ids:
+            return
+        cr = self.env.cr
+        cr.execute("DELETE FROM mail_message "
+                   "WHERE model = %s AND res_id IN %s",
+                   (self._name, tuple(job_ids)))
+        cr.execute("DELETE FROM mail_followers "
+                   "WHERE res_model = %s AND res_id IN %s",
+                   (self._name, tuple(job_ids)))
+
 
 class QueueWorker(models.Model):
     """ Worker """
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import cPickle
+import logging
 import mock
+import time
 import unittest2
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from openerp import SUPERUSER_ID, exceptions
 import openerp.tests.common as common
@@ -12,12 +14,15 @@ from openerp.addons.connector.queue.job import (
     JobStorage,
     OpenERPJobStorage,
     job,
+    identity_exact,
     PENDING,
     ENQUEUED,
     DONE,
     STARTED,
     FAILED,
     _unpickle,
+    _serialize_func,
+    _deserialize_func,
     RETRY_INTERVAL,
 )
 from openerp.addons.connector.session import (
@@ -30,6 +35,8 @@ from openerp.addons.connector.exception import (
     RetryableJobError,
 )
 
+_logger = logging.getLogger(__name__)
+
 
 def task_b(session, model_name):
     pass
@@ -65,6 +72,11 @@ def pickle_allowed_function(session):
     pass
 
 
+@job(identity_key=identity_exact)
+def identity_task(session, model_name, a, b=None):
+    return a
+
+
 class TestJobs(unittest2.TestCase):
     """ Test Job """
 
@@ -345,6 +357,99 @@ class TestJobs(unittest2.TestCase):
         with self.assertRaises(NotReadableJobError):
             self.assertEqual(_unpickle('cucumber'))
 
+    def test_serialize(self):
+        """ arguments are serialized in JSON when possible """
+        func_name = 'openerp.addons.connector.tests.test_job.dummy_task'
+        values = [
+            (('res.users', 1, 2 ** 70, 1.5, None, True), {'c': '!'}),
+            ((u'öô¿‽', [1, (2, 3)], {'a': {u'ö': (1,)}}), {'c': u'ßø'}),
+            ((u'ascii', ['name', u'name'], {'$x': 1}), {'c': (u'a', 'b')}),
+            ((datetime(2016, 2, 10, 1, 2, 3, 5), datetime(2016, 2, 10),
+              date(2016, 2, 10), timedelta(1, 2, 3)), {}),
+        ]
+        for args, kwargs in values:
+            serialized = _serialize_func(func_name, args, kwargs)
+            self.assertTrue(serialized.startswith('{'))
+            read = _deserialize_func(serialized)
+            self.assertEqual(read, (func_name, args, kwargs))
+            self.assertEqual([type(arg) for arg in read[1]],
+                             [type(arg) for arg in args])
+            self.assertEqual(repr(read[1]), repr(args))
+            self.assertEqual(repr(read[2]), repr(kwargs))
+            self.assertEqual([type(key) for key in read[2]],
+                             [str] * len(kwargs))
+            self.assertEqual(type(read[0]), str)
+
+    def test_serialize_fallback(self):
+        """ arguments which cannot be stored in JSON are pickled """
+        func_name = 'openerp.addons.connector.tests.test_job.dummy_task'
+        for args in [('öô¿‽',), ({1: 2},), ({'ö': 2},), ({'$t': []},)]:
+            serialized = _serialize_func(func_name, args, {})
+            self.assertFalse(serialized.startswith('{'))
+            self.assertEqual(_deserialize_func(serialized),
+                             (func_name, args, {}))
+
+    def test_deserialize_not_readable(self):
+        with self.assertRaises(NotReadableJobError):
+            _deserialize_func('{"v": 1000}')
+        with self.assertRaises(NotReadableJobError):
+            _deserialize_func('{"v": 1, "a": [{"$dt": "2016"}], "f": "a"}')
+        with self.assertRaises(NotReadableJobError):
+            _deserialize_func(cPickle.dumps(pickle_forbidden_function))
+
+    def test_serialize_benchmark(self):
+        """ compare the size and speed of JSON and pickle """
+        func_name = ('openerp.addons.magentoerpconnect.unit.'
+                     'import_synchronizer.import_record')
+        calls = [
+            (('magento.res.partner', 7), {}),
+            (('magento.product.product', 42,
+              ['name', 'default_code', 'list_price']), {}),
+            (('magento.sale.order', 3, '100000123'), {'force': True}),
+            (('product.product', range(20000),
+              [{'name': u'Product %d' % i, 'qty': i * 1.5}
+               for i in range(2000)]), {}),
+        ]
+        for args, kwargs in calls:
+            start = time.time()
+            pickled = cPickle.dumps((func_name, args, kwargs))
+            pickle_dump = time.time() - start
+            start = time.time()
+            _unpickle(pickled)
+            pickle_load = time.time() - start
+            start = time.time()
+            serialized = _serialize_func(func_name, args, kwargs)
+            json_dump = time.time() - start
+            start = time.time()
+            self.assertEqual(_deserialize_func(serialized),
+                             (func_name, args, kwargs))
+            json_load = time.time() - start
+            _logger.info("job function serialization: JSON %d bytes, "
+                         "dump %.4fs, load %.4fs; pickle %d bytes, "
+                         "dump %.4fs, load %.4fs", len(serialized),
+                         json_dump, json_load, len(pickled), pickle_dump,
+                         pickle_load)
+            self.assertLessEqual(len(serialized), len(pickled))
+
+    def test_identity_key(self):
+        job_a = Job(func=identity_task, args=('res.users', 'a'),
+                    kwargs={'b': 1})
+        job_b = Job(func=identity_task, args=('res.users', 'a'),
+                    kwargs={'b': 1})
+        job_c = Job(func=identity_task, args=('res.users', 'a'),
+                    kwargs={'b': 2})
+        self.assertTrue(job_a.identity_key)
+        self.assertEqual(job_a.identity_key, job_b.identity_key)
+        self.assertNotEqual(job_a.identity_key, job_c.identity_key)
+        # no identity key by default
+        self.assertIsNone(Job(func=task_a).identity_key)
+        # the key can be given on the job
+        test_job = Job(func=identity_task, args=('res.users', 'a'),
+                       identity_key='key')
+        self.assertEqual(test_job.identity_key, 'key')
+        test_job = Job(func=task_a, identity_key=lambda job_: job_.func_name)
+        self.assertEqual(test_job.identity_key, test_job.func_name)
+
     def test_not_implemented_job_storage(self):
         storage = JobStorage()
         job_a = mock.Mock()
@@ -425,6 +530,63 @@ class TestJobStorage(common.TransactionCase):
                                delta=delta)
         self.assertEqual(job_read.canceled, True)
 
+    def test_queries_per_job(self):
+        """ a job is loaded and updated with a single query """
+        worker = self.env['queue.worker'].create(
+            {'uuid': '57569b99-c2c1-47b6-aad1-72f953c92c87'}
+        )
+        test_job = Job(func=dummy_task_args,
+                       model_name='res.users',
+                       args=('o', 'k'),
+                       kwargs={'c': '!'})
+        storage = OpenERPJobStorage(self.session)
+        storage.store(test_job)
+        stored = self.queue_job.search([('uuid', '=', test_job.uuid)])
+        self.assertEqual(stored.state, PENDING)
+
+        count = self.cr.sql_log_count
+        job_read = storage.load(test_job.uuid)
+        self.assertEqual(self.cr.sql_log_count - count, 1)
+
+        job_read.set_enqueued(worker)
+        count = self.cr.sql_log_count
+        storage.store(job_read)
+        self.assertEqual(self.cr.sql_log_count - count, 1)
+        # the cache has been invalidated
+        self.assertEqual(stored.state, ENQUEUED)
+        self.assertEqual(stored.worker_id, worker)
+
+        job_read = storage.load(test_job.uuid)
+        self.assertEqual(job_read.worker_uuid, worker.uuid)
+        self.assertEqual(job_read.args, test_job.args)
+
+    def test_claim(self):
+        """ only an enqueued job can be claimed, with a single query """
+        worker = self.env['queue.worker'].create(
+            {'uuid': '57569b99-c2c1-47b6-aad1-72f953c92c87'}
+        )
+        test_job = Job(func=dummy_task_args,
+                       model_name='res.users',
+                       args=('o', 'k'),
+                       kwargs={'c': '!'})
+        storage = OpenERPJobStorage(self.session)
+        storage.store(test_job)
+        self.assertIsNone(storage.claim(test_job.uuid))
+        test_job.set_enqueued(worker)
+        storage.store(test_job)
+        count = self.cr.sql_log_count
+        job_read = storage.claim(test_job.uuid)
+        self.assertEqual(self.cr.sql_log_count - count, 1)
+        self.assertEqual(job_read.state, STARTED)
+        self.assertTrue(job_read.date_started)
+        self.assertEqual(job_read.worker_uuid, worker.uuid)
+        self.assertEqual(job_read.args, test_job.args)
+        stored = self.queue_job.search([('uuid', '=', test_job.uuid)])
+        self.assertEqual(stored.state, STARTED)
+        # already started
+        self.assertIsNone(storage.claim(test_job.uuid))
+        self.assertIsNone(storage.claim('unknown-uuid'))
+
     def test_job_worker(self):
         worker = self.env['queue.worker'].create(
             {'uuid': '57569b99-c2c1-47b6-aad1-72f953c92c87'}
@@ -510,6 +672,103 @@ class TestJobStorage(common.TransactionCase):
         stored = self.queue_job.search([])
         self.assertEqual(len(stored), 1)
 
+    def test_job_delay_many(self):
+        self.cr.execute('delete from queue_job')
+        job(dummy_task_args)
+        self.env['queue.job.function']._register_jobs()
+        job_uuids = dummy_task_args.delay_many(
+            self.session, 'res.users', [('o', 'k'), ('a', 'b')],
+            c='!', priority=15)
+        stored = self.queue_job.search([], order='id')
+        self.assertEqual(stored.mapped('uuid'), job_uuids)
+        self.assertEqual(stored.mapped('priority'), [15, 15])
+        self.assertEqual(stored.mapped('state'), [PENDING, PENDING])
+        self.assertEqual(stored.mapped('channel'), ['root', 'root'])
+        self.assertTrue(all(stored.mapped('job_function_id')))
+        storage = OpenERPJobStorage(self.session)
+        job_read = storage.load(job_uuids[1])
+        self.assertEqual(job_read.args, ('res.users', 'a', 'b'))
+        self.assertEqual(job_read.kwargs, {'c': '!'})
+        self.assertEqual(job_read.perform(self.session), 'ab!')
+
+    def test_identity_key_delay(self):
+        """ a job is not created when an identical job is pending """
+        uuid_a = identity_task.delay(self.session, 'res.users', 'a')
+        uuid_b = identity_task.delay(self.session, 'res.users', 'a')
+        uuid_c = identity_task.delay(self.session, 'res.users', 'c')
+        self.assertEqual(uuid_a, uuid_b)
+        self.assertNotEqual(uuid_a, uuid_c)
+        stored = self.queue_job.search([('uuid', 'in', [uuid_a, uuid_c])])
+        self.assertEqual(len(stored), 2)
+        # the job is not pending anymore, a new one can be created
+        storage = OpenERPJobStorage(self.session)
+        job_a = storage.load(uuid_a)
+        job_a.set_enqueued(mock.Mock(uuid=None))
+        storage.store(job_a)
+        uuid_d = identity_task.delay(self.session, 'res.users', 'a')
+        self.assertNotEqual(uuid_a, uuid_d)
+        stored = self.queue_job.search(
+            [('identity_key', '=', job_a.identity_key)])
+        self.assertEqual(len(stored), 2)
+
+    def test_identity_key_delay_many(self):
+        """ a job created by another transaction meanwhile is skipped """
+        uuid_a = identity_task.delay(self.session, 'res.users', 'a')
+        pending_job_uuids = OpenERPJobStorage._pending_job_uuids
+        calls = []
+
+        def not_yet_visible(storage, identity_keys):
+            calls.append(identity_keys)
+            if len(calls) == 1:
+                return {}
+            return pending_job_uuids(storage, identity_keys)
+
+        with mock.patch.object(OpenERPJobStorage, '_pending_job_uuids',
+                               autospec=True, side_effect=not_yet_visible):
+            job_uuids = identity_task.delay_many(
+                self.session, 'res.users', [('a',), ('b',)])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(job_uuids[0], uuid_a)
+        stored = self.queue_job.search([('uuid', 'in', job_uuids)])
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(stored.mapped('state'), [PENDING, PENDING])
+
+    def test_identity_key_not_visible(self):
+        """ no uuid is returned for a job identical to a job pending in a
+        transaction which is not visible """
+        uuid_a = identity_task.delay(self.session, 'res.users', 'a')
+        with mock.patch.object(OpenERPJobStorage, '_pending_job_uuids',
+                               autospec=True, return_value={}):
+            self.assertIsNone(
+                identity_task.delay(self.session, 'res.users', 'a'))
+            job_uuids = identity_task.delay_many(
+                self.session, 'res.users', [('a',), ('b',), ('a',)])
+        self.assertEqual(len(job_uuids), 1)
+        self.assertNotEqual(job_uuids[0], uuid_a)
+        stored = self.queue_job.search(
+            [('func_name', 'like', 'identity_task')])
+        self.assertEqual(sorted(stored.mapped('uuid')),
+                         sorted([uuid_a, job_uuids[0]]))
+
+    def test_identity_key_requeue(self):
+        """ a job set back to pending is canceled if an identical job is
+        pending """
+        storage = OpenERPJobStorage(self.session)
+        uuid_a = identity_task.delay(self.session, 'res.users', 'a')
+        job_a = storage.load(uuid_a)
+        job_a.set_enqueued(mock.Mock(uuid=None))
+        storage.store(job_a)
+        uuid_b = identity_task.delay(self.session, 'res.users', 'a')
+        self.assertNotEqual(uuid_a, uuid_b)
+        job_a.set_pending()
+        storage.store(job_a)
+        stored = self.queue_job.with_context(active_test=False).search(
+            [('uuid', '=', uuid_a)])
+        self.assertEqual(stored.state, DONE)
+        self.assertFalse(stored.active)
+        stored = self.queue_job.search([('uuid', '=', uuid_b)])
+        self.assertEqual(stored.state, PENDING)
+
 
 class TestJobModel(common.TransactionCase):
 
@@ -582,9 +841,82 @@ class TestJobModel(common.TransactionCase):
         stored2 = self._create_job()
         stored.write({'date_done': '2000-01-01 00:00:00'})
         stored2.write({'date_done': '2000-01-01 00:00:00', 'active': False})
-        self.env['queue.job'].autovacuum()
+        # the test transaction must not be committed
+        with mock.patch.object(self.cr, 'commit') as commit:
+            self.env['queue.job'].autovacuum()
+        self.assertTrue(commit.called)
         self.assertEqual(len(self.env['queue.job'].search([])), 0)
 
+    def test_autovacuum_time_budget(self):
+        """ the jobs are removed by chunks until the time budget is spent """
+        stored = self._create_job()
+        stored2 = self._create_job()
+        stored3 = self._create_job()
+        (stored | stored2).write({'date_done': '2000-01-01 00:00:00',
+                                  'state': 'failed'})
+        self.assertTrue(stored.message_ids)
+        job_ids = (stored | stored2).ids
+        model = self.env['queue.job']
+        with mock.patch.object(self.cr, 'commit') as commit, \
+                mock.patch.object(type(model), '_removal_chunk_size', 1), \
+                mock.patch.object(type(model), '_removal_time_budget', 0):
+            model.autovacuum()
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(len(model.search([('id', 'in', job_ids)])), 1)
+        with mock.patch.object(self.cr, 'commit') as commit, \
+                mock.patch.object(type(model), '_removal_chunk_size', 1):
+            model.autovacuum()
+        # the last chunk is empty
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(model.search([]), stored3)
+        self.cr.execute("SELECT count(*) FROM mail_message "
+                        "WHERE model = 'queue.job' AND res_id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual(self.cr.fetchone()[0], 0)
+
+    def test_autovacuum_archive(self):
+        stored = self._create_job()
+        stored2 = self._create_job()
+        stored3 = self._create_job()
+        stored.write({'date_done': '2000-01-01 00:00:00',
+                      'state': 'failed'})
+        stored2.write({'date_done': '2000-01-01 00:00:00', 'active': False})
+        self.assertTrue(stored.message_ids)
+        job_ids = (stored | stored2).ids
+        model = self.env['queue.job']
+        with mock.patch.object(self.cr, 'commit'), \
+                mock.patch.object(type(model), '_archive', True), \
+                mock.patch.object(type(model), '_removal_chunk_size', 1):
+            model.autovacuum()
+        self.assertEqual(model.with_context(active_test=False).search([]),
+                         stored3)
+        self.cr.execute("SELECT uuid FROM queue_job_archive WHERE id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual(set(uuid for uuid, in self.cr.fetchall()),
+                         set([stored.uuid, stored2.uuid]))
+        self.cr.execute("SELECT count(*) FROM mail_message "
+                        "WHERE model = 'queue.job' AND res_id IN %s",
+                        (tuple(job_ids),))
+        self.assertEqual(self.cr.fetchone()[0], 0)
+
+    def test_requeue_identity_key(self):
+        """ a failed job is canceled when an identical job is pending """
+        uuid_a = identity_task.delay(self.session, 'res.users', 'a')
+        failed = self.queue_job.search([('uuid', '=', uuid_a)])
+        failed.write({'state': 'failed'})
+        uuid_b = identity_task.delay(self.session, 'res.users', 'a')
+        self.assertNotEqual(uuid_a, uuid_b)
+        model = self.env['queue.requeue.job']
+        model = model.with_context(active_model='queue.job',
+                                   active_ids=failed.ids)
+        model.create({}).requeue()
+        self.assertEqual(failed.state, DONE)
+        self.assertFalse(failed.active)
+        self.assertIn('identical job is already pending',
+                      failed.message_ids[0].body)
+        pending = self.queue_job.search([('uuid', '=', uuid_b)])
+        self.assertEqual(pending.state, PENDING)
+
     def test_wizard_requeue(self):
         stored = self._create_job()
         stored.write({'state': 'failed'})
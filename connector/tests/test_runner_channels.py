@@ -1,8 +1,185 @@
 # -*- coding: utf-8 -*-
+
 import doctest
-from openerp.addons.connector.jobrunner import channels
+import logging
+import random
+import sys
+import time
+from heapq import heappush, heappop
+
+import unittest2
+
+from openerp.addons.connector.jobrunner import benchmark, channels
+from openerp.addons.connector.jobrunner.channels import (ChannelJob,
+                                                         ChannelManager)
+
+_logger = logging.getLogger(__name__)
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(channels))
+    tests.addTests(doctest.DocTestSuite(benchmark))
     return tests
+
+
+class LegacyChannelJob(object):
+    """ ChannelJob as it was before it had slots and a sort key """
+
+    def __init__(self, db_name, channel, uuid,
+                 seq, date_created, priority, eta):
+        self.db_name = db_name
+        self.channel = channel
+        self.uuid = uuid
+        self.seq = seq
+        self.date_created = date_created
+        self.priority = priority
+        self.eta = eta
+
+    def __eq__(self, other):
+        return id(self) == id(other)
+
+    def __hash__(self):
+        return id(self)
+
+    def __cmp__(self, other):
+        if self.eta and not other.eta:
+            return -1
+        elif not self.eta and other.eta:
+            return 1
+        else:
+            return (cmp(self.eta, other.eta) or
+                    cmp(self.priority, other.priority) or
+                    cmp(self.date_created, other.date_created) or
+                    cmp(self.seq, other.seq))
+
+
+class TestChannelJobBenchmark(unittest2.TestCase):
+    """ Compare the memory and heap throughput of the channel jobs """
+
+    count = 20000
+
+    def _make_jobs(self, job_class):
+        rnd = random.Random(42)
+        jobs = []
+        for seq in range(self.count):
+            eta = rnd.choice([None] * 9 + [rnd.randint(1, 1000)])
+            jobs.append(job_class('db', None, 'uuid-%d' % seq,
+                                  seq=seq,
+                                  date_created=rnd.randint(1, 1000),
+                                  priority=rnd.randint(0, 20),
+                                  eta=eta))
+        return jobs
+
+    def _job_size(self, job):
+        size = sys.getsizeof(job)
+        if hasattr(job, '__dict__'):
+            size += sys.getsizeof(job.__dict__)
+        if hasattr(job, 'sort_key'):
+            size += sys.getsizeof(job.sort_key)
+        return size
+
+    def _heap_throughput(self, jobs):
+        heap = []
+        start = time.time()
+        for job in jobs:
+            heappush(heap, job)
+        popped = [heappop(heap) for __ in range(len(jobs))]
+        elapsed = time.time() - start
+        return popped, len(jobs) / max(elapsed, 1e-6)
+
+    def test_same_order(self):
+        """ The sort key orders jobs like the legacy comparison """
+        legacy_jobs, _ = self._heap_throughput(
+            self._make_jobs(LegacyChannelJob))
+        jobs, _ = self._heap_throughput(self._make_jobs(ChannelJob))
+        self.assertEqual([job.uuid for job in legacy_jobs],
+                         [job.uuid for job in jobs])
+
+    def test_benchmark(self):
+        legacy_jobs = self._make_jobs(LegacyChannelJob)
+        jobs = self._make_jobs(ChannelJob)
+        legacy_size = self._job_size(legacy_jobs[0])
+        size = self._job_size(jobs[0])
+        __, legacy_rate = self._heap_throughput(legacy_jobs)
+        __, rate = self._heap_throughput(jobs)
+        _logger.info("ChannelJob memory per job: %d bytes (before: %d), "
+                     "heap push+pop: %d jobs/s (before: %d jobs/s)",
+                     size, legacy_size, rate, legacy_rate)
+        self.assertFalse(hasattr(jobs[0], '__dict__'))
+        self.assertLess(size, legacy_size)
+
+
+class TestFairSharingSimulation(unittest2.TestCase):
+    """ Simulate a skewed load on two sibling channels """
+
+    def _simulate(self, config_string):
+        """ Channel A receives 200 jobs just before channel B receives 20.
+
+        Every job lasts one tick. Return the mean latency (ticks between
+        the notification and the start of the job) by channel.
+        """
+        cm = ChannelManager()
+        cm.simple_configure(config_string)
+        seq = 0
+        for channel, count in (('A', 200), ('B', 20)):
+            for __ in range(count):
+                cm.notify('db', channel, '%s%d' % (channel, seq),
+                          seq, 0, 10, None, 'pending')
+                seq += 1
+        latencies = {'A': [], 'B': []}
+        running = []
+        for tick in range(1000):
+            for uuid, channel, job_seq in running:
+                cm.notify('db', channel, uuid, job_seq, 0, 10, None, 'done')
+            running = [(job.uuid, job.channel.name, job.seq)
+                       for job in cm.get_jobs_to_run(now=tick)]
+            for __, channel, __ in running:
+                latencies[channel].append(tick)
+            if not running:
+                break
+        self.assertEqual(len(latencies['A']), 200)
+        self.assertEqual(len(latencies['B']), 20)
+        mean = dict((channel, float(sum(values)) / len(values))
+                    for channel, values in latencies.items())
+        _logger.info("mean latency with %s: %s", config_string, mean)
+        return mean
+
+    def test_fair_sharing(self):
+        strict = self._simulate('root:4,A:4,B:4')
+        fair = self._simulate('root:4:fair,A:4,B:4')
+        weighted = self._simulate('root:4:fair,A:4,B:4:weight=3')
+        # B waits for all the jobs of A unless the capacity is shared
+        self.assertGreater(strict['B'], 45)
+        self.assertLess(fair['B'], 10)
+        self.assertLess(weighted['B'], fair['B'])
+        # A is not starved either
+        self.assertLess(fair['A'], strict['A'] + 20)
+
+    def test_fair_sharing_batch(self):
+        """ A batch uses a single slot of the share of its channel """
+        cm = ChannelManager()
+        cm.simple_configure('root:4:fair,A:4:batch=5,B:4')
+        for seq in range(20):
+            for channel in ('A', 'B'):
+                cm.notify('db', channel, '%s%d' % (channel, seq),
+                          seq, 0, 10, None, 'pending')
+        slots = {'A': set(), 'B': set()}
+        for job in cm.get_jobs_to_run(now=0):
+            slots[job.channel.name].add(job.batch[0] if job.batch else job)
+        self.assertEqual(len(slots['A']), 2)
+        self.assertEqual(len(slots['B']), 2)
+
+
+class TestBenchmark(unittest2.TestCase):
+    """ Run the scheduling simulator on a small stream of jobs """
+
+    def test_simulate(self):
+        stats = benchmark.simulate(
+            jobs=2000, config='root:4:fair,A:2,B:2,C:1:sequential:rate=20/s',
+            failure_ratio=0.05)
+        self.assertEqual(stats['done'], 2000)
+        self.assertEqual(stats['dispatched'], 2000 + stats['retries'])
+        self.assertEqual(sorted(stats['latency']), ['A', 'B', 'C', 'all'])
+        self.assertTrue(stats['jobs_per_second'])
+        for latency in stats['latency'].values():
+            self.assertLessEqual(latency['p50'], latency['p99'])
@@ -1,8 +1,125 @@
 # -*- coding: utf-8 -*-
 import doctest
+import time
+
+import mock
+import requests
+import unittest2
+
 from openerp.addons.connector.jobrunner import runner
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(runner))
     return tests
+
+
+class TestHttpDispatcher(unittest2.TestCase):
+    """ Test the handling of the errors of the dispatcher """
+
+    def setUp(self):
+        self.dispatcher = runner.HttpDispatcher(8069)
+        self.endpoint = self.dispatcher.endpoints[0]
+        self.session = mock.MagicMock()
+        patcher = mock.patch.object(self.dispatcher, '_get_session',
+                                    return_value=self.session)
+        self.get_session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _is_healthy(self):
+        return self.endpoint.is_healthy(time.time())
+
+    def test_job_error(self):
+        """ a job failing quickly does not eject the endpoint """
+        response = self.session.get.return_value
+        response.raise_for_status.side_effect = requests.HTTPError(
+            '500 Server Error')
+        self.dispatcher._http_get('db', ['A'])
+        self.assertTrue(self._is_healthy())
+        self.assertEqual(self.dispatcher.errors, 0)
+        self.assertEqual(self.dispatcher.pop_failed(), [('db', 'A')])
+
+    def test_connection_error(self):
+        self.session.get.side_effect = requests.ConnectionError()
+        self.dispatcher._http_get('db', ['A'])
+        self.assertFalse(self._is_healthy())
+        self.assertEqual(self.dispatcher.errors, 1)
+        self.assertEqual(self.dispatcher.pop_failed(), [('db', 'A')])
+        self.assertFalse(self.endpoint.in_flight)
+
+    def test_login_error(self):
+        self.get_session.side_effect = requests.HTTPError('500 Server Error')
+        self.dispatcher._http_get('db', ['A'])
+        self.assertFalse(self._is_healthy())
+        self.assertEqual(self.dispatcher.errors, 1)
+        self.assertEqual(self.dispatcher.pop_failed(), [('db', 'A')])
+
+    def test_timeout(self):
+        """ the job is running """
+        self.session.get.side_effect = requests.Timeout()
+        self.dispatcher._http_get('db', ['A'])
+        self.assertTrue(self._is_healthy())
+        self.assertEqual(self.dispatcher.errors, 0)
+        self.assertEqual(self.dispatcher.pop_failed(), [('db', 'A')])
+
+
+class TestConnectorRunner(unittest2.TestCase):
+    """ Test the handling of the errors of the databases """
+
+    def setUp(self):
+        self.runner = runner.ConnectorRunner()
+        self.db = mock.Mock(db_name='db')
+        self.runner.db_by_name['db'] = self.db
+
+    def test_requeue_error(self):
+        """ the jobs are requeued on the next pass after an error """
+        self.runner.dispatcher._set_failed('db', ['A'])
+        self.db.set_jobs_pending.side_effect = Exception('connection lost')
+        self.runner.requeue_failed_dispatches()
+        self.db.set_jobs_pending.side_effect = None
+        self.db.set_jobs_pending.return_value = set(['A'])
+        self.runner.requeue_failed_dispatches()
+        self.db.set_jobs_pending.assert_called_with(['A'],
+                                                    (runner.ENQUEUED,))
+        self.db.set_jobs_pending.reset_mock()
+        self.runner.requeue_failed_dispatches()
+        self.assertFalse(self.db.set_jobs_pending.called)
+
+    def test_remove_database(self):
+        """ the jobs of a removed database are not in flight anymore """
+        self.runner.channel_manager.notify('db', None, 'A', 1, 0, 10, None,
+                                           'enqueued')
+        endpoint = self.runner.dispatcher._acquire_endpoint(['A'])
+        self.runner.remove_database('db')
+        self.assertFalse(endpoint.in_flight)
+        self.assertTrue(self.db.close.called)
+
+    def test_update_metrics(self):
+        """ the metrics are built by the runner thread """
+        self.runner._metrics_server = mock.Mock()
+        self.runner.channel_manager.notify('db', None, 'A', 1, 0, 10, None,
+                                           'pending')
+        self.assertEqual(self.runner.metrics, '')
+        self.runner.update_metrics()
+        self.assertIn('connector_channel_queued{channel="root"} 1\n',
+                      self.runner.metrics)
+
+    @mock.patch.object(runner, 'Database')
+    def test_discover_databases(self, database):
+        """ the databases without connector are not checked each time """
+        database.return_value.has_connector = False
+        self.db.check_connector.return_value = False
+        with mock.patch.object(self.runner, 'get_db_names',
+                               return_value=['db', 'other']):
+            self.runner.discover_databases()
+            # connector has been uninstalled
+            self.assertNotIn('db', self.runner.db_by_name)
+            self.assertTrue(self.db.close.called)
+            self.assertEqual(database.call_count, 2)
+            self.runner.discover_databases()
+            self.assertEqual(database.call_count, 2)
+            for db_name in self.runner._no_connector_db_names:
+                self.runner._no_connector_db_names[db_name] -= (
+                    runner.NO_CONNECTOR_RECHECK_INTERVAL)
+            self.runner.discover_databases()
+            self.assertEqual(database.call_count, 4)